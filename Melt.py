@@ -1,10 +1,121 @@
 from gi.repository import GLib, GObject
 
 import Process
+import probe
 
 import tempfile
+import hashlib
+import bisect
+import logging
+import time
 import os
 import re
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+class AnalysisCache(object):
+    """Keeps the MLT XML produced by the audio analysis pass so it does not
+have to be redone when the same content is transcoded again.
+
+Entries are keyed by the md5 of the file content (taken when the file is
+ingested) and the melt arguments. The source path inside the XML is
+swapped for a placeholder so the entry works for any path the content shows
+up at. Entries older than max_age seconds go away, and the oldest ones when
+the whole thing grows over max_bytes."""
+    placeholder = '@@PATERO_SOURCE@@'
+
+    def __init__(self, path, max_bytes=256*1024*1024, max_age=30*24*3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, md5, args):
+        h = hashlib.sha1()
+        h.update(' '.join(args))
+        h.update(md5)
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.mlt')
+
+    def get(self, key, src, mlt):
+        """Writes the cached analysis for key into mlt, pointing to src.
+Returns False on a miss."""
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as f:
+                xml = f.read()
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return False
+
+        with open(mlt, 'wb') as f:
+            f.write(xml.replace(self.placeholder, escape(src)))
+        return True
+
+    def put(self, key, src, mlt):
+        try:
+            with open(mlt, 'rb') as f:
+                xml = f.read()
+        except IOError:
+            return
+
+        if escape(src) not in xml:
+            # melt made the path relative or something, we can't relocate it.
+            logging.debug('Melt: not caching analysis of %s', src)
+            return
+
+        entry = self._entry(key)
+        tmp = entry + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(xml.replace(escape(src), self.placeholder))
+        os.rename(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.path):
+            if not name.endswith('.mlt'):
+                continue
+            entry = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                os.unlink(entry)
+                continue
+            entries.append( (st.st_mtime, st.st_size, entry) )
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(entry)
+            total -= size
+
+def split_points(length, step, keyframes=[], start_time=0.0):
+    """Returns the (start, end) seconds of segments about step long covering
+length, each one starting on the first keyframe after its nominal start if
+there are keyframes to choose from."""
+    keyframes = [t - start_time for t in keyframes]
+    cuts = [0.0]
+    target = step
+    while target < length - step / 2.0:
+        cut = target
+        if keyframes:
+            i = bisect.bisect_left(keyframes, target)
+            if i == len(keyframes):
+                break
+            cut = keyframes[i]
+        if cut >= length - step / 2.0:
+            break
+        cuts.append(cut)
+        target = cut + step
+    return zip(cuts, cuts[1:] + [length])
 
 class Transcode(GObject.GObject):
     __gsignals__ = {
@@ -18,7 +129,8 @@ class Transcode(GObject.GObject):
         'start-video': (GObject.SIGNAL_RUN_FIRST, None, ())
     }
 
-    def __init__(self, src, dst=None, destdir=None):
+    def __init__(self, src, dst=None, destdir=None, cache=None, checksum=None,
+                 segment_seconds=0, parallelism=2):
         GObject.GObject.__init__(self)
 
         self.errstr = ''
@@ -35,6 +147,15 @@ class Transcode(GObject.GObject):
 
         self.src = src
         self.dst = dst
+        # without the md5 of src there is no cache key.
+        self.cache = cache if checksum else None
+        self.checksum = checksum
+        self.cache_key = None
+        self.segment_seconds = segment_seconds
+        self.parallelism = max(1, parallelism)
+        self.segments = []
+        self.encoders = {}
+        self.processes = []
         (fd, self.mlt) = tempfile.mkstemp('.mlt')
         os.close(fd)
 
@@ -45,8 +166,29 @@ class Transcode(GObject.GObject):
     def spawn (self, p):
         p = Process.Handler (p)
         p.connect ('stderr', self.stderr_cb)
+        self.processes.append(p)
         return p
 
+    def abort (self):
+        """Kills every melt (or ffmpeg) still running, nothing new starts."""
+        self.fail = True
+        self.pending = []
+        for p in self.processes:
+            if p.running:
+                try:
+                    p.process.kill()
+                except OSError:
+                    pass
+        self.remove_mlt()
+
+    def remove_mlt (self):
+        if self.mlt:
+            try:
+                os.remove (self.mlt)
+            except OSError:
+                pass
+            self.mlt = None
+
     def stderr_cb (self, o, s):
         print 'stderr', s
         if re.findall (r'Failed to load', s):
@@ -77,6 +219,16 @@ class Transcode(GObject.GObject):
             self.emit('finished', self.src, self.dst)
 
     def do_pass1 (self):
+        if self.cache is not None:
+            args = ['-filter', 'sox:analysis', 'video_off=1', 'all=1']
+            self.cache_key = self.cache.key(self.checksum, args)
+            if self.cache.get(self.cache_key, self.src.strip(), self.mlt.strip()):
+                logging.debug('Melt: reusing audio analysis of %s', self.src)
+                self.do_pass2()
+                return
+        self.analyze()
+
+    def analyze (self):
         prog = ['melt','-progress', self.src.strip(),
                 '-filter', 'sox:analysis',
                 '-consumer', 'xml:' + self.mlt.strip(),
@@ -85,23 +237,174 @@ class Transcode(GObject.GObject):
         self.emit('status', 'Normalizing audio')
         self.emit('start-audio')
         p = self.spawn(prog)
-        p.connect ('exit', self.check_fail, self.do_pass2)
+        p.connect ('exit', self.check_fail, self.pass1_done)
 
-    def do_pass2 (self):
-        prog = ['melt','-progress', self.mlt.strip(),
-                '-consumer', 'avformat:' + self.dst.strip(),
+    def pass1_done (self):
+        if self.cache is not None and self.cache_key:
+            self.cache.put(self.cache_key, self.src.strip(), self.mlt.strip())
+        self.do_pass2()
+
+    def encoder_args (self, dst):
+        return ['-consumer', 'avformat:' + dst,
                 'properties=H.264', 'strict=experimental', 'progressive=1']
 
+    def do_pass2 (self):
+        if self.segment_seconds:
+            probe.probe_async(self.src.strip(), self.plan_segments)
+            return
+        self.encode_whole()
+
+    def encode_whole (self):
+        prog = ['melt','-progress', self.mlt.strip()] + self.encoder_args(self.dst.strip())
+
         self.emit('status', 'Transcoding video')
         self.emit('start-video')
         p = self.spawn(prog)
         p.connect ('exit',self.check_fail, self.alldone)
 
+    def mlt_fps (self):
+        try:
+            profile = ElementTree.parse(self.mlt.strip()).getroot().find('profile')
+            return float(profile.get('frame_rate_num')) / float(profile.get('frame_rate_den'))
+        except (IOError, ElementTree.ParseError, AttributeError, TypeError, ValueError, ZeroDivisionError):
+            return None
+
+    def plan_segments (self, info):
+        if self.fail:
+            return
+        length = probe.duration(info)
+        if length < 2 * self.segment_seconds or not self.mlt_fps():
+            self.encode_whole()
+            return
+
+        try:
+            start_time = float(info['format'].get('start_time', 0))
+        except (TypeError, ValueError):
+            start_time = 0.0
+
+        self.emit('status', 'Looking for keyframes')
+        probe.keyframes_async(self.src.strip(), self.split, length, start_time)
+
+    def split (self, keyframes, length, start_time):
+        if self.fail:
+            return
+        fps = self.mlt_fps()
+        points = split_points(length, self.segment_seconds, keyframes, start_time)
+        if len(points) < 2:
+            self.encode_whole()
+            return
+
+        # every segment is cut from the analysed XML, so they all get the
+        # same audio normalization.
+        self.segments = []
+        for i, (start, end) in enumerate(points):
+            seg = {
+                'path': '%s.part%03d.m4v' % (self.dst.strip(), i),
+                'in': int(round(start * fps)),
+                'out': None,
+                'length': end - start,
+                'done': 0.0,
+            }
+            if i < len(points) - 1:
+                seg['out'] = int(round(end * fps)) - 1
+            self.segments.append(seg)
+
+        self.pending = list(self.segments)
+        self.emit('status', 'Transcoding video (%d segments)' % len(self.segments))
+        self.emit('start-video')
+        for i in range(self.parallelism):
+            self.next_segment()
+
+    def next_segment (self):
+        if self.fail:
+            return
+        if not self.pending:
+            if not self.encoders:
+                self.join_segments()
+            return
+
+        seg = self.pending.pop(0)
+        prog = ['melt', '-progress', self.mlt.strip(), 'in=%d' % seg['in']]
+        if seg['out'] is not None:
+            prog.append('out=%d' % seg['out'])
+        prog += self.encoder_args(seg['path'])
+
+        p = Process.Handler (prog)
+        p.connect ('stderr', self.segment_stderr_cb, seg)
+        p.connect ('exit', self.segment_exit_cb, seg)
+        self.encoders[seg['path']] = p
+        self.processes.append(p)
+
+    def segment_stderr_cb (self, o, s, seg):
+        if re.findall (r'Failed to load', s):
+            self.segment_failed(s)
+            return True
+
+        try:
+            perc = float(re.findall(r'percentage:\s+(\d+).$', s)[0])
+        except IndexError:
+            return True
+
+        seg['done'] = perc
+        total = sum(x['length'] for x in self.segments)
+        self.emit('progress', sum(x['done'] * x['length'] for x in self.segments) / total)
+        return True
+
+    def segment_exit_cb (self, process, ret, seg):
+        self.encoders.pop(seg['path'], None)
+        if ret != 0 and not self.fail:
+            self.segment_failed('Melt error')
+
+        if self.fail:
+            if not self.encoders:
+                self.remove_segments()
+            return
+        self.next_segment()
+
+    def segment_failed (self, error):
+        self.fail = True
+        self.pending = []
+        for p in self.encoders.values():
+            try:
+                p.process.kill()
+            except OSError:
+                pass
+        self.emit('error', error)
+
+    def remove_segments (self):
+        for seg in self.segments:
+            try:
+                os.unlink(seg['path'])
+            except OSError:
+                pass
+        if os.path.exists(self.dst.strip() + '.parts'):
+            os.unlink(self.dst.strip() + '.parts')
+
+    def join_segments (self):
+        parts = self.dst.strip() + '.parts'
+        with open(parts, 'w') as f:
+            for seg in self.segments:
+                f.write("file '%s'\n" % seg['path'].replace("'", "'\\''"))
+
+        prog = ['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', parts,
+                '-c', 'copy', self.dst.strip()]
+
+        self.emit('status', 'Joining segments')
+        p = Process.Handler (prog)
+        p.connect ('stderr', lambda o, s: logging.error('Melt: concat: %s', s))
+        p.connect ('exit', self.joined)
+        self.processes.append(p)
+
+    def joined (self, process, ret):
+        self.remove_segments()
+        if ret != 0:
+            self.emit('error', 'Could not join segments')
+            return
+        self.alldone()
+
     def alldone (self):
         dst = self.dst
-        if self.mlt:
-            os.remove (self.mlt)
-            self.mlt = None
+        self.remove_mlt()
 
         self.emit('success', self.dst)
         self.emit('finished', self.src, self.dst)
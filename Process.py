@@ -1,6 +1,7 @@
 from gi.repository import GObject, GLib
 
 import subprocess
+import errno
 import os
 import re
 
@@ -42,8 +43,16 @@ class Handler (GObject.GObject):
         self.nonblock (self.process.stderr.fileno())
         self.nonblock (self.process.stdout.fileno())
 
+        # output is delivered as soon as the kernel tells us there is some,
+        # the exit status when GLib reaps the child.
+        self.watches = {}
+        for fd, out in [('stdout', process.stdout), ('stderr', process.stderr)]:
+            self.watches[fd] = GLib.io_add_watch(out.fileno(), GLib.PRIORITY_DEFAULT,
+                                                 GLib.IO_IN | GLib.IO_PRI | GLib.IO_HUP | GLib.IO_ERR,
+                                                 self.on_output, fd)
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, process.pid, self.on_child_exit)
+
         self.running = True
-        GLib.timeout_add (200, self.check_runing)
         return True
 
     def then (self, command):
@@ -56,41 +65,66 @@ class Handler (GObject.GObject):
         except:
             print "error no callback"
 
-    def check_line (self, fd):
+    def get_pipe (self, fd):
         if fd == 'stderr':
-            out = self.process.stderr
+            return self.process.stderr
         elif fd == 'stdout':
-            out = self.process.stdout
-        else:
-            return None
+            return self.process.stdout
+        return None
+
+    def read_pipe (self, fd):
+        """Reads whatever is available on fd without blocking and emits it.
+Returns False once the pipe is at EOF."""
+        out = self.get_pipe (fd)
+        if out is None or out.closed:
+            return False
 
-        try:
-            line = out.read()
-            self.emit(fd, line)
-        except:
-            return None
+        while True:
+            try:
+                data = os.read(out.fileno(), 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                return False
+
+            if not data:
+                return False
 
-        return line
+            self.emit(fd, data)
 
-    def check_runing (self):
-        ret = self.process.poll()
+    def close_pipe (self, fd):
+        watch = self.watches.pop(fd, None)
+        if watch is not None:
+            GLib.source_remove(watch)
 
-        self.check_line ('stderr')
-        self.check_line ('stdout')
+        out = self.get_pipe (fd)
+        if out is not None and not out.closed:
+            out.close()
 
-        if ret == None:
+    def on_output (self, source, condition, fd):
+        if self.read_pipe (fd):
             return True
 
-        self.emit ('exit', ret)
-        self.running = False
+        # the watch is removed by returning False.
+        self.watches.pop(fd, None)
+        self.get_pipe (fd).close()
+        return False
 
-#        try:
-#            next_cmd = self.next_cmd.pop()
-#            self.run(next_cmd)
-#        except:
-#            pass
+    def on_child_exit (self, pid, status):
+        if os.WIFSIGNALED(status):
+            ret = -os.WTERMSIG(status)
+        else:
+            ret = os.WEXITSTATUS(status)
+        self.process.returncode = ret
 
-        return False
+        # flush what is left on the pipes so every bit of output is
+        # emitted before 'exit', even if some grandchild keeps them open.
+        for fd in ['stderr', 'stdout']:
+            self.read_pipe (fd)
+            self.close_pipe (fd)
+
+        self.running = False
+        self.emit ('exit', ret)
 
 def dump (s, d, e):
     print "DUMP:", e, s, d
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import uuid
+import atexit
+import logging
+import datetime
+import threading
 import redis, json
-from copy import deepcopy
+from collections import OrderedDict
 
 import pymongo
 from pymongo import MongoClient
 
+from gi.repository import GLib
+
 from common import *
 from gredis import RedisListener
+from threadpool import idle_call
 
 redis = redis.Redis(host=redis_host, port=redis_port, db=redis_db)
 
@@ -17,10 +25,319 @@ _client_id = unicode( uuid.uuid4() )
 
 listener = RedisListener(redis=redis, client_id = _client_id)
 
+class Publisher(object):
+    """Queues messages and sends them to Redis pipelined, once per main loop
+iteration or every 'batch' messages, whatever comes first. Messages go out in
+the same order they were published."""
+    def __init__(self, redis, batch=100):
+        self.redis = redis
+        self.batch = batch
+        self.pending = []
+        self._idle_id = None
+
+    def publish(self, channel, message):
+        self.pending.append( (channel, message) )
+        if len(self.pending) >= self.batch:
+            self.flush()
+        elif self._idle_id is None:
+            self._idle_id = GLib.idle_add(self._flush_cb)
+
+    def _flush_cb(self):
+        self._idle_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for channel, message in pending:
+            pipe.publish(channel, message)
+        pipe.execute()
+
+publisher = Publisher(redis, batch=sync_batch_size)
+
+_sync_methods = frozenset('create read update delete'.split())
+
+class Router(object):
+    """Hands the sync messages coming from Redis to whatever is bound to
+them. Each message is decoded once, then goes to the collections bound to
+its channel and to the models bound to the id it is about, so the cost of
+a message doesn't depend on how many models are bound."""
+    def __init__(self, listener):
+        self.listener = listener
+        self.collections = {}  # channel -> [collection]
+        self.models = {}       # channel -> {id: [model]}
+        self.id_attributes = {}  # channel -> idAttribute of its models
+        self._handler = None
+
+    def _subscribe(self, channel):
+        if self._handler is None:
+            self._handler = self.listener.connect('message', self._on_message)
+        if channel not in self.collections and channel not in self.models:
+            self.listener.subscribe(channel)
+
+    def bind_collection(self, collection):
+        self._subscribe(collection._channel)
+        self.collections.setdefault(collection._channel, []).append(collection)
+
+    def unbind_collection(self, collection):
+        bound = self.collections.get(collection._channel, [])
+        if collection in bound:
+            bound.remove(collection)
+
+    def bind_model(self, model, _id):
+        self._subscribe(model._channel)
+        self.id_attributes[model._channel] = model.idAttribute
+        self.models.setdefault(model._channel, {}).setdefault(_id, []).append(model)
+
+    def unbind_model(self, model, _id):
+        ids = self.models.get(model._channel, {})
+        bound = ids.get(_id, [])
+        if model in bound:
+            bound.remove(model)
+        if not bound:
+            ids.pop(_id, None)
+
+    def _on_message(self, listener, message):
+        channel = message.get('channel', None)
+        collections = self.collections.get(channel, None)
+        models = self.models.get(channel, None)
+        if not (collections or models):
+            return
+
+        try:
+            data = json.loads(message['data'])
+        except (TypeError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+
+        if data.get('_redis_source', _client_id) == _client_id:
+            return
+
+        method = data.get('method', None)
+        model = data.get('model', None)
+        if not isinstance(model, dict) or method not in _sync_methods:
+            return
+
+        for collection in list(collections or []):
+            collection._on_sync(method, model, data)
+
+        if models:
+            try:
+                bound = models.get(model.get(self.id_attributes[channel], None), None)
+            except TypeError:
+                return
+            for m in list(bound or []):
+                m._on_sync(method, model, data)
+
+router = Router(listener)
+
 # XXX: according to mongo docs we only need to create one client and share it everywhere
 client = MongoClient(mongocnstr)
 db = client[dbname]
 
+def _plain(value):
+    """A deep copy of value made of plain dicts and lists, safe to hand to
+another thread."""
+    if isinstance(value, dict):
+        return dict( (k, _plain(v)) for k, v in dict.iteritems(value) )
+    if isinstance(value, list):
+        return [ _plain(v) for v in list.__iter__(value) ]
+    return value
+
+def _merge_writes(old, new):
+    """Combines two writes to the same document into one with the effect of
+doing both in order. Writes are ('upsert', doc), ('update', update) with
+only top level $set/$unset, or ('remove',)."""
+    if new[0] != 'update' or old[0] == 'remove':
+        return new
+
+    sets = new[1].get('$set', {})
+    unsets = new[1].get('$unset', {})
+    if old[0] == 'upsert':
+        doc = dict(old[1])
+        for k in unsets:
+            doc.pop(k, None)
+        doc.update(sets)
+        return ('upsert', doc)
+
+    merged_sets = dict(old[1].get('$set', {}))
+    merged_unsets = dict(old[1].get('$unset', {}))
+    for k in unsets:
+        merged_sets.pop(k, None)
+        merged_unsets[k] = ''
+    for k, v in sets.iteritems():
+        merged_unsets.pop(k, None)
+        merged_sets[k] = v
+
+    update = {}
+    if merged_sets:
+        update['$set'] = merged_sets
+    if merged_unsets:
+        update['$unset'] = merged_unsets
+    return ('update', update)
+
+class WriteBehind(object):
+    """Writes to mongo from a background thread so a slow database doesn't
+stall the main loop.
+
+Writes are kept per document in arrival order, a new write for a document
+that is still waiting is merged into it so only the latest state gets
+written. Every write is idempotent (updates only $set/$unset whole top level
+attributes) so a batch that failed is simply retried. At most 'size'
+documents wait, put() blocks when there are more. flush() waits until
+everything is written, for changes that must be durable before going on,
+when_written() calls back once they are without waiting."""
+    def __init__(self, size=1000, batch=100):
+        self.size = size
+        self.batch = batch
+        self.pending = OrderedDict()  # (collection name, id) -> (collection, id, write)
+        self.busy = 0
+        self.writing = set()   # keys of the batch being written
+        self.waiters = []      # [set of keys still to be written, callback]
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, name='write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush, 10)
+
+    def put(self, col, _id, write):
+        key = (col.full_name, _id)
+        with self.cond:
+            if key in self.pending:
+                old = self.pending[key][2]
+                self.pending[key] = (col, _id, _merge_writes(old, write))
+            else:
+                if len(self.pending) >= self.size:
+                    logging.warning('WriteBehind: %d writes waiting, blocking', len(self.pending))
+                while len(self.pending) >= self.size:
+                    self.cond.wait()
+                self.pending[key] = (col, _id, write)
+            self.cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until every write made so far is in the database, returns
+False if timeout seconds went by first."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while self.pending or self.busy:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+        return True
+
+    def when_written(self, callback):
+        """Calls callback() on the main loop once every write made so far
+is in the database, right away if there is nothing waiting."""
+        with self.cond:
+            keys = set(self.pending) | self.writing
+            if keys:
+                self.waiters.append( [keys, callback] )
+                return
+        callback()
+
+    def _run(self):
+        delay = 1
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch = []
+                while self.pending and len(batch) < self.batch:
+                    batch.append(self.pending.popitem(last=False))
+                self.busy = len(batch)
+                self.writing = set( key for key, entry in batch )
+
+            failed = self._write([ entry for key, entry in batch ])
+
+            with self.cond:
+                # what failed goes back in front, merged with anything newer.
+                for key, entry in reversed(batch[len(batch) - len(failed):]):
+                    write = entry[2]
+                    if key in self.pending:
+                        write = _merge_writes(write, self.pending.pop(key)[2])
+                    self.pending[key] = (entry[0], entry[1], write)
+                    _move_to_front(self.pending, key)
+
+                written = set( key for key, entry in batch[:len(batch) - len(failed)] )
+                for waiter in self.waiters[:]:
+                    waiter[0] -= written
+                    if not waiter[0]:
+                        self.waiters.remove(waiter)
+                        idle_call(waiter[1])
+                self.busy = 0
+                self.writing = set()
+                self.cond.notify_all()
+
+            if failed:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                delay = 1
+
+    def _write(self, entries):
+        """Writes entries in order, returns the ones from the first one that
+failed on."""
+        i = 0
+        while i < len(entries):
+            # consecutive writes to the same collection go as one bulk op
+            # where pymongo supports it.
+            col = entries[i][0]
+            j = i
+            while j < len(entries) and entries[j][0].full_name == col.full_name:
+                j += 1
+            try:
+                self._write_group(col, entries[i:j])
+            except pymongo.errors.PyMongoError, e:
+                logging.error('WriteBehind: writing to %s failed: %s', col.full_name, e)
+                return entries[i:]
+            i = j
+        return []
+
+    def _write_group(self, col, entries):
+        if hasattr(col, 'initialize_ordered_bulk_op'):
+            bulk = col.initialize_ordered_bulk_op()
+            for _, _id, write in entries:
+                if write[0] == 'upsert':
+                    bulk.find({'_id': _id}).upsert().replace_one(write[1])
+                elif write[0] == 'update' and write[1]:
+                    bulk.find({'_id': _id}).update_one(write[1])
+                elif write[0] == 'remove':
+                    bulk.find({'_id': _id}).remove_one()
+            bulk.execute()
+            return
+
+        for _, _id, write in entries:
+            if write[0] == 'upsert':
+                col.update({'_id': _id}, write[1], True)
+            elif write[0] == 'update' and write[1]:
+                col.update({'_id': _id}, write[1])
+            elif write[0] == 'remove':
+                col.remove({'_id': _id})
+
+def _move_to_front(odict, key):
+    value = odict.pop(key)
+    items = odict.items()
+    odict.clear()
+    odict[key] = value
+    odict.update(items)
+
+# with write_behind on, models are written to mongo by this one.
+writer = None
+if write_behind:
+    writer = WriteBehind(int(write_behind_queue), int(write_behind_batch))
+
 def deep_get(d, key):
     """Given a nested dictionary structure and a path like 'a.b.c' tries
 to retrieve it. Returns a tuple of (value, found). If the path is not on
@@ -28,7 +345,14 @@ the structure the returned value is also None"""
     found = True
     current = d
     for k in key.split('.'):
-        if k in current:
+        if isinstance(current, list):
+            # mongo style 'list.3.attribute' paths.
+            try:
+                current = current[int(k)]
+            except (ValueError, IndexError):
+                found = False
+                break
+        elif k in current:
             # current can also be something like "aaaaakbbbb"
             # so while the 'in' test succeeds you can not access it
             # like a dict.
@@ -46,23 +370,238 @@ the structure the returned value is also None"""
     else:
         return (current, True)
 
+def _join(path, key):
+    if path is None:
+        return unicode(key)
+    return u'%s.%s' % (path, key)
+
+def _track(value, owner, path):
+    """Returns value ready to be stored at 'path' inside owner, dicts and
+lists are (recursively) copied into their tracked versions."""
+    if isinstance(value, (TrackedDict, TrackedList)):
+        if value._owner is owner and value._path == path:
+            return value
+    if isinstance(value, dict):
+        return TrackedDict(owner, path, value)
+    if isinstance(value, list):
+        return TrackedList(owner, path, value)
+    return value
+
+def _repath(value, path):
+    """Moves an already tracked value to a new path, used when list items
+change position."""
+    if isinstance(value, TrackedDict):
+        value._path = path
+        for k, v in dict.iteritems(value):
+            _repath(v, _join(path, k))
+    elif isinstance(value, TrackedList):
+        value._path = path
+        for idx, v in enumerate(list.__iter__(value)):
+            _repath(v, _join(path, idx))
+
+class TrackedDict(dict):
+    """A dict that tells the Model it belongs to which of its keys get
+modified, so only those are written on save(). Copies and pickles of it are
+plain dicts."""
+    __slots__ = ('_owner', '_path')
+
+    def __init__(self, owner, path, items=()):
+        dict.__init__(self)
+        self._owner = owner
+        self._path  = path
+        for k, v in dict(items).iteritems():
+            dict.__setitem__(self, k, _track(v, owner, _join(path, k)))
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        path = _join(self._path, key)
+        dict.__setitem__(self, key, _track(value, self._owner, path))
+        self._owner._mark(path, 'set')
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._owner._mark(_join(self._path, key), 'unset')
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._owner._mark(_join(self._path, key), 'unset')
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._owner._mark(_join(self._path, key), 'unset')
+        return (key, value)
+
+    def clear(self):
+        dict.clear(self)
+        self._owner._mark(self._path, 'set')
+
+class TrackedList(list):
+    """Same as TrackedDict for lists. append() and extend() become a $push,
+anything that moves the items around rewrites the whole list."""
+    __slots__ = ('_owner', '_path')
+
+    def __init__(self, owner, path, items=()):
+        list.__init__(self)
+        self._owner = owner
+        self._path  = path
+        for v in items:
+            list.append(self, _track(v, owner, _join(path, len(self))))
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def _rewrite(self):
+        for idx in range(len(self)):
+            value = list.__getitem__(self, idx)
+            path = _join(self._path, idx)
+            if isinstance(value, (TrackedDict, TrackedList)) and value._owner is self._owner:
+                _repath(value, path)
+            else:
+                list.__setitem__(self, idx, _track(value, self._owner, path))
+        self._owner._mark(self._path, 'set')
+
+    def append(self, value):
+        value = _track(value, self._owner, _join(self._path, len(self)))
+        list.append(self, value)
+        self._owner._mark(self._path, 'push', value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __setitem__(self, idx, value):
+        if isinstance(idx, slice):
+            list.__setitem__(self, idx, value)
+            self._rewrite()
+            return
+        if idx < 0:
+            idx += len(self)
+        path = _join(self._path, idx)
+        list.__setitem__(self, idx, _track(value, self._owner, path))
+        self._owner._mark(path, 'set')
+
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, values)
+        self._rewrite()
+
+    def __delitem__(self, idx):
+        list.__delitem__(self, idx)
+        self._rewrite()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._rewrite()
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._rewrite()
+        return self
+
+    def insert(self, idx, value):
+        list.insert(self, idx, value)
+        self._rewrite()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self._rewrite()
+        return ret
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._rewrite()
+
+    def reverse(self):
+        list.reverse(self)
+        self._rewrite()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._rewrite()
+
+# marks a missing (or unhashable) attribute in the Collection indexes.
+_missing = object()
+
 class BackboneException(Exception):
     pass
 
+# (colname, backend) -> (mongo collection, redis channel), shared by every
+# instance of a class.
+_endpoints = {}
+
+def _tombstones(colname):
+    """The collection that remembers which documents of colname were
+deleted, and when, for Collection.fetch({'since': ...})."""
+    return db[colname + '.tombstones']
+
+_last_stamp = 0
+
+def _stamp():
+    """A timestamp for the update stamp of a model, never the same twice in
+this process even if the clock goes back."""
+    global _last_stamp
+    _last_stamp = max(time.time(), _last_stamp + 1e-6)
+    return _last_stamp
+
+def _endpoint(colname, backend):
+    key = (colname, backend)
+    if key not in _endpoints:
+        col = None
+        if colname:
+            col = db[colname]
+        _endpoints[key] = (col, '_RedisSync.' + re.sub('backend$', '', backend))
+    return _endpoints[key]
+
 class Base(object):
     """Common stuff for Backbone compatibility.
 It is quite tied for now to our redis+mongo structure"""
     # some of this will go away once I get sane 'read' support over Redis.
+    __slots__   = ('_col', '_channel', '_events')
     colname     = ''
     backend     = ''
 
     def __init__(self):
-        if self.colname:
-            self._col = db[self.colname]
-        else:
-            self._col = None
+        self._col, self._channel = _endpoint(self.colname, self.backend)
+        # most models never get a listener, don't give each one a dict.
+        self._events = None
+
+    def on(self, event, callback, *args):
+        """Like Backbone.Events.on(), callback gets called as
+callback(*trigger_args + args)"""
+        if self._events is None:
+            self._events = {}
+        self._events.setdefault(event, []).append( (callback, args) )
+
+    def off(self, event=None, callback=None):
+        if event is None or self._events is None:
+            self._events = None
+            return
+        if callback is None:
+            self._events.pop(event, None)
+            return
+        handlers = [ h for h in self._events.get(event, []) if h[0] != callback ]
+        self._events[event] = handlers
 
-        self._channel = '_RedisSync.' + re.sub('backend$', '', self.backend)
+    def trigger(self, event, *args):
+        if self._events is None:
+            return
+        for callback, extra in list(self._events.get(event, [])):
+            callback(*(args + extra))
 
     def sync(self, method, model=None, options=None):
         # XXX: dumb and not generic. for now it only broadcast to Redis.
@@ -83,7 +622,10 @@ It is quite tied for now to our redis+mongo structure"""
             'model': model,
             '_redis_source': _client_id,
         }
-        redis.publish(self._channel, json.dumps(req))
+        # top level attributes that were removed, for partial updates.
+        if options and options.get('unset'):
+            req['unset'] = options['unset']
+        publisher.publish(self._channel, json.dumps(req))
 
 class Model(Base):
     """A class that somehow mimics Backbone.Model
@@ -91,64 +633,183 @@ class Model(Base):
 Besides the standard Backbone methods (get, set, update) you can also access it
 like a normal python dict, however it will not trigger change notifications.
 
+Changes are tracked down to nested keys (as long as they are made through the
+model or the dicts and lists it hands out, not on .attributes directly) so
+save() only sends a $set/$unset/$push with what changed, and syncs only the
+top level attributes that were touched. Saving an unchanged model does
+nothing.
+
+Nested dicts and lists (including the ones in defaults, which are shared by
+every instance) are only copied into their tracked versions the first time
+they are handed out, so .attributes must be treated as read only.
+
+Every save() stamps the model with the time in updatedAttribute, and destroy()
+leaves a tombstone, so collections can fetch only what changed since a given
+time.
+
 To define your models do someting like:
 
 class MyModel(Model):
+    __slots__ = () # models have no per instance __dict__, keep it that way.
     colname = 'the mongo collection' #
     backend = 'backend name' #used for live sync over Redis.
     defaults = {} # optional dictionary with default values.
 """
+    __slots__   = ('id', 'collection', 'attributes', '_dirty',
+                   '_bound', '_save_timer', '_last_save')
     idAttribute = '_id'
-    id          = None
+    updatedAttribute = '_updated'
     defaults    = {}
 
     def __init__(self, attributes=None):
         super(Model, self).__init__()
+        self.id = None
         self.collection = None
-        self.attributes = deepcopy(self.defaults)
-        self._redis_handler = None
+        self._bound = _missing   # the id we are bound to the router with
+        self._save_timer = None
+        self._last_save = 0
 
+        doc = dict(self.defaults)
         if attributes is not None:
-            self.attributes.update(attributes)
+            doc.update(attributes)
             self.id = attributes.get(self.idAttribute, None)
+        self._load(doc)
+
+    def _load(self, doc):
+        # values are tracked lazily, see _get_attr().
+        self.attributes = doc
+        # path -> ('set',) | ('unset',) | ('push', [items])
+        self._dirty = {}
+
+    def _get_attr(self, key):
+        """Returns the attribute, turning it into its tracked version the
+first time if it is a dict or list."""
+        value = self.attributes[key]
+        if isinstance(value, (dict, list)) and not isinstance(value, (TrackedDict, TrackedList)):
+            value = self.attributes[key] = _track(value, self, key)
+        return value
+
+    def _mark(self, path, op, item=None):
+        """Records that 'path' changed. Mongo refuses to touch a path and
+something below it in the same update, so overlapping changes are merged
+into a $set of the outermost one."""
+        dirty = self._dirty
+
+        parts = path.split('.')
+        for i in range(1, len(parts)):
+            ancestor = '.'.join(parts[:i])
+            if ancestor in dirty:
+                if dirty[ancestor][0] != 'set':
+                    self._mark(ancestor, 'set')
+                return
 
+        prefix = path + '.'
+        below = [ p for p in dirty if p.startswith(prefix) ]
+        if below:
+            for p in below:
+                del( dirty[p] )
+            if op == 'push':
+                op = 'set'
+
+        if op == 'push':
+            current = dirty.get(path, None)
+            if current is None:
+                dirty[path] = ('push', [item])
+            elif current[0] == 'push':
+                current[1].append(item)
+            else:
+                dirty[path] = ('set',)
+        else:
+            dirty[path] = (op,)
+
+    def hasChanged(self, attr=None):
+        """Whether the model, or only attr if given, has changes that were
+not saved yet."""
+        if attr is None:
+            return bool(self._dirty)
+        return attr in self._dirty
+
+    def _delta(self):
+        """Returns (update, changed, unset): the mongo update document for
+the pending changes, the touched top level attributes and the removed ones."""
+        update = {}
+        tops = set()
+        for path, change in self._dirty.iteritems():
+            tops.add(path.split('.')[0])
+            op = change[0]
+            if op == 'set':
+                value, found = deep_get(self.attributes, path)
+                if found:
+                    update.setdefault('$set', {})[path] = value
+                else:
+                    update.setdefault('$unset', {})[path] = ''
+            elif op == 'unset':
+                update.setdefault('$unset', {})[path] = ''
+            elif op == 'push':
+                update.setdefault('$push', {})[path] = {'$each': list(change[1])}
+
+        changed = { self.idAttribute: self.id }
+        unset = []
+        for top in tops:
+            if top in self.attributes:
+                changed[top] = self.attributes[top]
+            else:
+                unset.append(top)
 
-    def bindRedis(self):
-        listener.subscribe(self._channel)
-        self._redis_handler = listener.connect('message', self._on_backend)
-
-    def _on_backend(self, listener, message):
-        data = json.loads(message['data'])
-        if message.get('channel', None) != self._channel:
-            return
-
-        if data.get('_redis_source', _client_id) == _client_id:
-            return
+        return (update, changed, unset)
 
-        method = data.get('method', None)
-        model = data.get('model', None)
-        if model is None:
-            return
 
-        if method not in 'create read update delete'.split():
+    def bindRedis(self):
+        if self._bound is not _missing:
             return
+        self._bound = self.attributes.get(self.idAttribute, None)
+        router.bind_model(self, self._bound)
 
-        if model.get(self.idAttribute, None) != self.attributes[self.idAttribute]:
-            return
+    def unbindRedis(self):
+        if self._bound is not _missing:
+            router.unbind_model(self, self._bound)
+            self._bound = _missing
 
+    def _on_sync(self, method, model, data):
+        """Called by the router with a message from another node about this
+model."""
         if method == 'update':
-            self.set(model)
+            self.set(model, {'synced': True})
+            if data.get('unset', None):
+                self.set(dict.fromkeys(data['unset']), {'synced': True, 'unset': True})
         elif method == 'delete':
             self.destroy()
 
     def __getitem__(self, key):
-        return self.attributes[key]
+        return self._get_attr(key)
+
+    def _changed(self):
+        # lets the collection keep its indexes up to date.
+        if self.collection is not None:
+            self.collection._reindex(self)
+
+    def _set_attr(self, key, value, mark=True):
+        attributes = self.attributes
+        if key in attributes and not isinstance(value, (dict, list)):
+            old = attributes[key]
+            if type(old) is type(value) and old == value:
+                return
+        attributes[key] = _track(value, self, key)
+        if mark:
+            self._mark(key, 'set')
+
+    def _del_attr(self, key, mark=True):
+        del( self.attributes[key] )
+        if mark:
+            self._mark(key, 'unset')
 
     def __setitem__(self, key, value):
-        self.attributes[key] = value
+        self._set_attr(key, value)
+        self._changed()
 
     def __delitem__(self, key):
-        del( self.attributes[key] )
+        self._del_attr(key)
+        self._changed()
 
     def __iter__(self, *args, **kwargs):
         return iter(self.attributes)
@@ -160,38 +821,68 @@ class MyModel(Model):
         return self.attributes.keys()
 
     def values(self):
-        return self.attributes.values()
+        return list(self.itervalues())
 
     def items(self):
-        return self.attributes.items()
+        return list(self.iteritems())
 
     def iterkeys(self):
         return self.attributes.iterkeys()
 
     def itervalues(self):
-        return self.attributes.itervalues()
+        for key in self.attributes.keys():
+            yield self._get_attr(key)
 
     def iteritems(self):
-        return self.attributes.iteritems()
-
-    def get(self, *args, **kwargs):
-        return self.attributes.get(*args, **kwargs)
-
-    def pop(self, *args, **kwargs):
-        return self.attributes.pop(*args, **kwargs)
-
-    def popitem(self, *args, **kwargs):
-        return self.attributes.popitem(*args, **kwargs)
-
-    def setdefault(self, *args, **kwargs):
-        return self.attributes.setdefault(*args, **kwargs)
+        for key in self.attributes.keys():
+            yield (key, self._get_attr(key))
+
+    def get(self, key, default=None):
+        if key not in self.attributes:
+            return default
+        return self._get_attr(key)
+
+    def pop(self, key, *args):
+        if key in self.attributes:
+            self._mark(key, 'unset')
+        ret = self.attributes.pop(key, *args)
+        self._changed()
+        return ret
+
+    def popitem(self):
+        key, value = self.attributes.popitem()
+        self._mark(key, 'unset')
+        self._changed()
+        return (key, value)
+
+    def setdefault(self, key, default=None):
+        if key not in self.attributes:
+            self._set_attr(key, default)
+            self._changed()
+        return self._get_attr(key)
 
     def update(self, *args, **kwargs):
-        return self.attributes.update(*args, **kwargs)
+        for k,v in dict(*args, **kwargs).iteritems():
+            self._set_attr(k, v)
+        self._changed()
 
     def set(self, attributes, options=None):
-        self.attributes = attributes.copy()
+        """Merges attributes into the model like Backbone does. Options:
+'unset': removes the given attributes instead.
+'synced': the values come from the database or another node, they are not
+recorded as changes to be saved."""
+        options = options or {}
+        mark = not options.get('synced', False)
+
+        for k,v in attributes.iteritems():
+            if options.get('unset', False):
+                if k in self.attributes:
+                    self._del_attr(k, mark)
+            else:
+                self._set_attr(k, v, mark)
+
         self.id = self.attributes.get(self.idAttribute, None)
+        self._changed()
 
     def fetch(self, options=None):
 #XXX: need to move all of this into a generic sync.
@@ -205,37 +896,127 @@ class MyModel(Model):
         else:
             ret = self._col.find_one()
 
-        self.attributes = deepcopy(self.defaults)
+        doc = dict(self.defaults)
         if ret is not None:
-            self.attributes.update(ret)
+            doc.update(ret)
+        self._load(doc)
+        self._changed()
+
+    def save_later(self, delay):
+        """Saves the model at most once every 'delay' seconds, whatever the
+model holds by then is what gets written. Meant for things like progress
+updates, a regular save() takes care of anything still pending."""
+        if self._save_timer is not None:
+            return
+
+        wait = self._last_save + delay - time.time()
+        if wait <= 0:
+            self.save()
+        else:
+            self._save_timer = GLib.timeout_add(int(wait * 1000), self._save_later_cb)
+
+    def _save_later_cb(self):
+        self._save_timer = None
+        self.save()
+        return False
+
+    def _cancel_save_later(self):
+        if self._save_timer is not None:
+            GLib.source_remove(self._save_timer)
+            self._save_timer = None
+
+    def discard_changes(self):
+        """Forgets whatever changed since the last save without writing it,
+a pending save_later() included."""
+        self._cancel_save_later()
+        self._dirty = {}
 
     def save(self, attributes=None, options=None):
+        """Writes whatever changed. With write_behind on the write happens
+later, unless options has 'flush', then this waits (up to
+write_behind_flush_timeout seconds) until it and anything before it is in
+the database. Returns False if it wasn't written in time.
+options can also have 'success', a function called (on the main loop) once
+the write is in the database, without waiting for it."""
+        options = options or {}
+        self._save(attributes)
+        success = options.get('success', None)
+        if writer is None or self._col is None:
+            if success is not None:
+                success()
+            return True
+
+        if success is not None:
+            writer.when_written(success)
+        if options.get('flush', False):
+            if not writer.flush(float(write_behind_flush_timeout)):
+                logging.warning('WriteBehind: %s %s not written after %s seconds, it stays queued',
+                                self.colname, self.id, write_behind_flush_timeout)
+                return False
+        return True
+
+    def _save(self, attributes):
+        self._cancel_save_later()
+        self._last_save = time.time()
+
         if attributes is not None:
-            self.attributes.update(attributes)
+            self.update(attributes)
 
-        method = 'update'
         if self.id is None:
             # ObjectID gives a lot of trouble when(if) we want to send it over Redis.
             self.id = self.attributes.get(self.idAttribute, None) or unicode( uuid.uuid4() )
             self.attributes[self.idAttribute] = self.id
-            method = 'create'
+            self.attributes[self.updatedAttribute] = _stamp()
+            self._dirty = {}
+
+            if self._col is not None:
+                if writer is not None:
+                    writer.put(self._col, self.id, ('upsert', _plain(self.attributes)))
+                else:
+                    self._col.update({'_id': self.id}, self.attributes, True)
+            self.sync('create')
+            return
+
+        if not self._dirty:
+            return
 
-        if self._col:
-            self._col.update({'_id': self.id}, self.attributes, True)
-        self.sync(method)
+        self.attributes[self.updatedAttribute] = _stamp()
+        self._mark(self.updatedAttribute, 'set')
+        update, changed, unset = self._delta()
+        self._dirty = {}
+
+        if self._col is not None:
+            if writer is not None:
+                # whole top level attributes, so the write can be merged and retried.
+                update = {'$set': dict( (k, _plain(v)) for k, v in changed.iteritems() if k != self.idAttribute )}
+                if unset:
+                    update['$unset'] = dict.fromkeys(unset, '')
+                writer.put(self._col, self.id, ('update', update))
+            else:
+                self._col.update({'_id': self.id}, update)
+        self.sync('update', changed, {'unset': unset})
 
     def destroy(self, options=None):
+        self._cancel_save_later()
         if self.id is not None:
-            if self._col:
-                self._col.remove({'_id': self.id})
+            if self._col is not None:
+                tombstone = {
+                    '_id': self.id,
+                    self.updatedAttribute: _stamp(),
+                    'at': datetime.datetime.utcnow(),   # for the TTL index.
+                }
+                if writer is not None:
+                    writer.put(self._col, self.id, ('remove',))
+                    writer.put(_tombstones(self.colname), self.id, ('upsert', tombstone))
+                else:
+                    self._col.remove({'_id': self.id})
+                    _tombstones(self.colname).save(tombstone)
             self.sync('delete')
 
         if self.collection:
             self.collection.remove(self)
 
-        if self._redis_handler is not None:
-            listener.disconnect(self._redis_handler)
-            self._redis_handler = None
+        self.unbindRedis()
 
 
 class Collection(Base):
@@ -250,53 +1031,139 @@ class MyCollection(Collection):
     colname = 'the mongo collection' #
     backend = 'backend name' # used for live sync over Redis.
     model   = MyModel
+    indexes = ['attribute'] # optional, attributes to keep a lookup index on.
+    db_indexes = [[('attribute', 1)]] # optional, indexes ensure_indexes() creates in mongo.
+
+Like in Backbone you can listen to 'add', 'remove' and 'change:attribute'
+events with on(), the later only for indexed attributes.
+
+The models are kept in insertion order keyed by id. For every attribute in
+'indexes' there is a value -> models map that where() and findWhere() use
+instead of scanning the whole collection, it is refreshed every time a model
+is changed through its methods (but not when a nested value is modified in
+place).
 """
 
-    model = Model
+    model   = Model
+    indexes = []
+    db_indexes = []
 
     def __init__(self, models=None, options=None):
         super(Collection, self).__init__()
 
-        self.models = []
-        self._models = {}
-        self._redis_handler = None
+        self._reset()
+        self._bound = False
+        # when the last fetch() started and the query of the last complete
+        # one, see resync().
+        self._synced_at = None
+        self._query = {}
 
         if models is not None:
             for m in models:
-                if isinstance(m, Model):
-                    M = m
-                else:
-                    M = self.model(m)
-
-                self.models.append(M)
-                self._models[M.id] = M
-                M.collection = self
-
-    def bindRedis(self):
-        listener.subscribe(self._channel)
-        self._redis_handler = listener.connect('message', self._on_backend)
-
-    def _on_backend(self, listener, message):
-        data = json.loads(message['data'])
-        if message.get('channel', None) != self._channel:
+                self.add(m)
+
+    def _reset(self):
+        self._models = OrderedDict()
+        # attribute -> value -> OrderedDict(id -> model)
+        self._indexes = dict( (attr, {}) for attr in self.indexes )
+        # id -> {attribute: value} as it was last indexed.
+        self._indexed = {}
+
+    @property
+    def models(self):
+        return self._models.values()
+
+    def _index_value(self, model, attr):
+        value = model.attributes.get(attr, _missing)
+        try:
+            hash(value)
+        except TypeError:
+            return _missing
+        return value
+
+    def _unindex(self, model):
+        for attr, value in self._indexed.pop(model.id, {}).iteritems():
+            bucket = self._indexes[attr].get(value)
+            if bucket is None:
+                continue
+            bucket.pop(model.id, None)
+            if not bucket:
+                del( self._indexes[attr][value] )
+
+    def _reindex(self, model):
+        """Refreshes the indexes for model, triggers a 'change:attribute'
+event for each indexed attribute whose value changed."""
+        if not self._indexes:
             return
 
-        if data.get('_redis_source', _client_id) == _client_id:
+        if self._models.get(model.id) is not model:
             return
 
-        method = data.get('method', None)
-        model = data.get('model', None)
-        if model is None:
+        old = self._indexed.get(model.id, {})
+        new = {}
+        changed = []
+        for attr, index in self._indexes.iteritems():
+            value = self._index_value(model, attr)
+            new[attr] = value
+            if attr in old and old[attr] == value:
+                continue
+
+            if attr in old:
+                bucket = index.get(old[attr])
+                if bucket is not None:
+                    bucket.pop(model.id, None)
+                    if not bucket:
+                        del( index[old[attr]] )
+
+            if value is not _missing:
+                bucket = index.get(value)
+                if bucket is None:
+                    bucket = index[value] = OrderedDict()
+                bucket[model.id] = model
+
+            if attr in old:
+                changed.append(attr)
+
+        self._indexed[model.id] = new
+
+        for attr in changed:
+            self.trigger('change:' + attr, model)
+
+    def ensure_indexes(self):
+        """Creates the indexes listed in db_indexes on the mongo collection,
+the ones that already exist are left alone. The update stamp and the
+tombstones are always indexed, the later expire after tombstone_days."""
+        if self._col is None:
             return
+        for keys in self.db_indexes:
+            self._col.ensure_index(keys)
 
-        if method not in 'create read update delete'.split():
-            return
+        updated = self.model.updatedAttribute
+        self._col.ensure_index([(updated, 1)])
+        tombstones = _tombstones(self.colname)
+        tombstones.ensure_index([(updated, 1)])
+        tombstones.ensure_index([('at', 1)], expireAfterSeconds=int(float(tombstone_days) * 24 * 3600))
 
+    def bindRedis(self):
+        if not self._bound:
+            self._bound = True
+            router.bind_collection(self)
+
+    def unbindRedis(self):
+        if self._bound:
+            self._bound = False
+            router.unbind_collection(self)
+
+    def _on_sync(self, method, model, data):
+        """Called by the router with a message from another node on our
+channel."""
         mid = model.get(self.model.idAttribute, None)
         mod = self._models.get(mid, None)
 
         if method == 'update' and mod is not None:
-            mod.set(model)
+            mod.set(model, {'synced': True})
+            if data.get('unset', None):
+                mod.set(dict.fromkeys(data['unset']), {'synced': True, 'unset': True})
         if method == 'delete' and mod is not None:
             mod.destroy()
 
@@ -304,13 +1171,15 @@ class MyCollection(Collection):
             self.add(model)
 
     def __iter__(self, *args, **kwargs):
-        return iter( self.models )
+        return iter( self._models.values() )
 
     def __contains__(self, item):
-        return item in self.models
+        if isinstance(item, Model):
+            return self._models.get(item.id, None) is item
+        return item in self._models
 
     def __len__(self):
-        return len(self.models)
+        return len(self._models)
 
     def __getitem__(self, key):
         return self._models[key]
@@ -329,10 +1198,25 @@ class MyCollection(Collection):
                     return False
             return True
 
+        candidates = None
+        for k,v in attributes.iteritems():
+            if k not in self._indexes:
+                continue
+            try:
+                bucket = self._indexes[k].get(v, {})
+            except TypeError:
+                continue
+            if candidates is None or len(bucket) < len(candidates):
+                candidates = bucket
+
+        if candidates is None:
+            candidates = self._models
+
         if _all:
-            return [ m for m in self if cmp(m) ]
+            # the caller may modify what we return and move it between buckets.
+            return [ m for m in candidates.values() if cmp(m) ]
         else:
-            for m in self:
+            for m in candidates.itervalues():
                 if cmp(m):
                     return m
 
@@ -341,18 +1225,114 @@ class MyCollection(Collection):
 
 #XXX:
     def fetch(self, options=None):
+        """Loads the models from mongo, by default all of them. options can
+have:
+
+    query:  only fetch the documents matching this spec.
+    fields: projection, the attributes to load.
+    sort:   list of (key, direction).
+    limit:  fetch at most this many documents.
+    after:  an id, fetch the documents with bigger ids (sorted by id unless
+            told otherwise) to page through large collections.
+    remove: if False the models already there are kept, so pages can be
+            added one after the other.
+    since:  a timestamp, only fetch what was saved or destroyed after it.
+            The changes are merged into the models already there (triggering
+            'add', 'remove' and 'change:attribute' as usual) instead of
+            starting over. Models that stop matching 'query' are not noticed.
+    merge:  like since, but every document matching 'query' is fetched and
+            merged, and the models not found are removed (unless saved here
+            since the previous fetch). Sees changes that weren't stamped.
+
+Returns the number of documents fetched."""
         # XXX: need to keep old attributes and fire a change or something.
-        # XXX: need to implement the merging behaviour inside set(). For now we just reset.
-
-        self.models = []
-        self._models = {}
+        options = options or {}
+        since = options.get('since', None)
+        merge = since is not None or options.get('merge', False)
+        started = time.time()
+
+        if not merge and options.get('remove', True):
+            self._reset()
+
+        query = options.get('query', {})
+        if since is None and options.get('after', None) is None:
+            self._query = query
+        sort = options.get('sort', None)
+        if since is not None:
+            query = {'$and': [query, {self.model.updatedAttribute: {'$gte': since}}]}
+        if options.get('after', None) is not None:
+            query = {'$and': [query, {'_id': {'$gt': options['after']}}]}
+            sort = sort or [('_id', 1)]
+
+        cursor = self._col.find(query, options.get('fields', None))
+        if sort:
+            cursor = cursor.sort(sort)
+        if options.get('limit', None):
+            cursor = cursor.limit(options['limit'])
+
+        count = 0
+        seen = set()
+        for m in cursor:
+            if not merge:
+                self.add(m, {'silent': True})
+            else:
+                self._merge(m, 'fields' not in options)
+                seen.add(m.get(self.model.idAttribute, None))
+            count += 1
+
+        if not merge:
+            self.trigger('reset', self)
+        elif since is None:
+            # gone, or not matching anymore. What we saved lately may not be
+            # written yet.
+            updated = self.model.updatedAttribute
+            for model in self._models.values():
+                if model.id in seen or model._dirty:
+                    continue
+                if self._synced_at is not None and model.attributes.get(updated, 0) >= self._synced_at:
+                    continue
+                self.remove(model)
+                count += 1
+        else:
+            spec = {self.model.updatedAttribute: {'$gte': since}}
+            for tombstone in _tombstones(self.colname).find(spec, {'_id': 1}):
+                model = self._models.get(tombstone['_id'], None)
+                if model is not None:
+                    self.remove(model)
+                    count += 1
+
+        self._synced_at = started
+        return count
+
+    def _merge(self, doc, complete=True):
+        """Adds doc, or updates the model we already have for it. If doc is
+complete the attributes it doesn't have are removed from the model."""
+        model = self._models.get(doc.get(self.model.idAttribute, None), None)
+        if model is None:
+            self.add(doc)
+            return
 
-        for m in self._col.find():
-            M = self.model(m)
-            self.models.append(M)
-            self._models[M.id] = M
-            M.collection = self
+        # we may have saved something newer that isn't written yet.
+        updated = self.model.updatedAttribute
+        if doc.get(updated, 0) < model.attributes.get(updated, 0):
+            return
 
+        missing = [ k for k in model.attributes if k not in doc ]
+        model.set(doc, {'synced': True})
+        if complete and missing:
+            model.set(dict.fromkeys(missing), {'synced': True, 'unset': True})
+
+    def resync(self, margin=60, full=False):
+        """Catches up with whatever changed since the last fetch(), for when
+sync messages may have been missed. margin covers for clocks not being
+quite in sync between nodes. That only sees what save() and destroy()
+stamped, full=True fetches everything the last complete fetch() did again
+and merges it, which also catches what others wrote."""
+        if self._synced_at is None:
+            return self.fetch()
+        if full:
+            return self.fetch({'query': self._query, 'merge': True})
+        return self.fetch({'since': self._synced_at - margin})
 
     def add(self, m, options=None):
         if isinstance(m, Model):
@@ -360,24 +1340,27 @@ class MyCollection(Collection):
         else:
             M = self.model(m)
 
-        if M in self.models:
+        if M.id in self._models:
             return
 
-        self.models.append(M)
         self._models[M.id] = M
         M.collection = self
+        self._reindex(M)
+        if not (options or {}).get('silent', False):
+            self.trigger('add', M)
 
     def remove(self, model, options=None):
         def _remove(m):
             if m not in self:
                 return
-            self.models.remove(m)
+            self._unindex(m)
             del( self._models[m.id] )
+            self.trigger('remove', m)
 
         if isinstance(model, Model):
             _remove(model)
         else:
-            for m in models:
+            for m in model:
                 _remove(m)
 
 #XXX:
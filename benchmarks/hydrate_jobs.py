@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measures how long it takes, and how much memory, to turn a lot of job
+documents (like the ones a fetch() gets from mongo) into a JobCollection.
+
+Run it from the top directory with the usual config in place:
+
+    python benchmarks/hydrate_jobs.py [--live] [count]
+
+Importing models connects to Redis and mongo, neither of which gets used
+while jobs are added to a collection, so unless --live is given both are
+replaced by fakes and the numbers can be taken anywhere.
+"""
+
+import os
+import sys
+import gc
+import time
+import uuid
+import types
+import socket
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+def _noop(*args, **kwargs):
+    return None
+
+def stub_backends():
+    """Puts fake pymongo, redis and hiredis modules (and gi, if it isn't
+installed) in sys.modules, enough to import models without any server."""
+    class Collection(object):
+        def __init__(self, full_name):
+            self.full_name = full_name
+        def __getattr__(self, name):
+            return _noop
+
+    class Database(object):
+        def __init__(self, name):
+            self.name = name
+        def __getitem__(self, name):
+            return Collection(self.name + '.' + name)
+
+    class MongoClient(object):
+        def __init__(self, *args, **kwargs):
+            pass
+        def __getitem__(self, name):
+            return Database(name)
+
+    class PyMongoError(Exception):
+        pass
+
+    errors = _module('pymongo.errors', PyMongoError=PyMongoError)
+    _module('pymongo', MongoClient=MongoClient, errors=errors, ASCENDING=1, DESCENDING=-1)
+
+    # the pub/sub connection gets one end of a socket pair, nothing ever
+    # arrives on it.
+    class Connection(object):
+        def __init__(self, **kwargs):
+            self._sock, self._peer = socket.socketpair()
+        def __getattr__(self, name):
+            return _noop
+
+    class ConnectionPool(object):
+        connection_class = Connection
+        connection_kwargs = {}
+
+    class Pipeline(object):
+        def __getattr__(self, name):
+            return _noop
+
+    class Redis(object):
+        def __init__(self, *args, **kwargs):
+            self.connection_pool = ConnectionPool()
+        def pipeline(self, *args, **kwargs):
+            return Pipeline()
+        def register_script(self, script):
+            return _noop
+        def __getattr__(self, name):
+            return _noop
+
+    class ConnectionError(Exception):
+        pass
+
+    exceptions = _module('redis.exceptions', ConnectionError=ConnectionError)
+    _module('redis', Redis=Redis, exceptions=exceptions)
+
+    class Reader(object):
+        def feed(self, data):
+            pass
+        def gets(self):
+            return False
+
+    class ProtocolError(Exception):
+        pass
+
+    _module('hiredis', Reader=Reader, ProtocolError=ProtocolError)
+
+    try:
+        from gi.repository import GLib, GObject
+    except ImportError:
+        _stub_gi()
+
+def _stub_gi():
+    class GLib(object):
+        # constants are flags that get or'ed, anything else a function.
+        def __getattr__(self, name):
+            if name.isupper():
+                return 0
+            return _noop
+
+    class GObjectBase(object):
+        def __init__(self):
+            self._handlers = {}
+        def connect(self, signal, callback, *args):
+            self._handlers.setdefault(signal, []).append( (callback, args) )
+        def emit(self, signal, *args):
+            for callback, extra in self._handlers.get(signal, []):
+                callback(self, *(args + extra))
+
+    GObject = _module('gi.repository.GObject', GObject=GObjectBase,
+                      SIGNAL_RUN_FIRST=1, TYPE_PYOBJECT=object)
+    repository = _module('gi.repository', GLib=GLib(), GObject=GObject)
+    _module('gi', repository=repository)
+
+def make_doc(i):
+    return {
+        '_id': unicode(uuid.uuid4()),
+        'input': {
+            'stat': {'size': 1024 * i, 'mtime': 1380000000.0 + i, 'ino': i, 'dev': 2049},
+            'path': u'/media/incoming/file-%06d.mov' % i,
+        },
+        'output': {
+            'checksum': '%032x' % i,
+            'checksums': {'md5': '%032x' % i},
+            'files': [u'/media/processed/%032x.mp4' % i, u'/media/processed/%032x.jpg' % i],
+            'metadata': {'type': 'video', 'durationsec': 60.0 + i % 3600},
+        },
+        'filename': u'file-%06d.mov' % i,
+        'stage': ['queued', 'processing', 'processing-done'][i % 3],
+        'progress': '0',
+        'tasks': [
+            {'name': 'Calculating checksum', 'status': 'done', 'message': ''},
+            {'name': 'Extracting metadata', 'status': 'done', 'message': ''},
+        ],
+    }
+
+def max_rss():
+    # kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--live' in args:
+        args.remove('--live')
+    else:
+        stub_backends()
+    from models import JobCollection
+
+    count = 100000
+    if args:
+        count = int(args[0])
+
+    docs = [ make_doc(i) for i in xrange(count) ]
+    gc.collect()
+    rss_before = max_rss()
+
+    collection = JobCollection()
+    start = time.time()
+    for doc in docs:
+        collection.add(doc, {'silent': True})
+    elapsed = time.time() - start
+
+    # the docs are thrown away after a real fetch.
+    del(docs)
+    gc.collect()
+
+    queued = len(collection.where({'stage': 'queued'}))
+    print 'hydrated %d jobs (%d queued) in %.2fs, %.1f us per job' % (len(collection), queued, elapsed, elapsed * 1e6 / count)
+    print 'peak RSS grew %.1f MiB, %.0f bytes per job' % ((max_rss() - rss_before) / 1024.0, (max_rss() - rss_before) * 1024.0 / count)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+
+import common
+from common import stat_key
+from threadpool import ThreadPool
+
+# hashlib releases the GIL while hashing big buffers, so with large reads
+# the threads really run in parallel.
+_bufsize = 4 * 1024 * 1024
+
+def _supported(algorithms):
+    ret = []
+    for name in algorithms:
+        try:
+            hashlib.new(name)
+        except ValueError:
+            logging.warning('Checksum: %s not supported by this hashlib, ignoring it', name)
+            continue
+        ret.append(name)
+    return ret
+
+# md5 always goes first as it is what Caspa uses to identify the media.
+algorithms = _supported(['md5'] + [ a for a in common.checksum_algorithms if a != 'md5' ])
+
+pool = ThreadPool(common.hash_threads, 'hash')
+
+class ChecksumCache(object):
+    """Digests of files we have already hashed, stored in sqlite. Entries
+are looked up by (dev, inode) and only used if size and mtime still match,
+otherwise they are dropped. Safe to use from several threads."""
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                algorithm TEXT, digest TEXT,
+                PRIMARY KEY (dev, ino, algorithm))''')
+            self.db.commit()
+
+    def get(self, st, algorithms):
+        """Returns {algorithm: digest} if all of them are known for the
+file st (an os.stat() result) is about, None otherwise."""
+        dev, ino, size, mtime_ns = stat_key(st)
+        with self.lock:
+            rows = self.db.execute('SELECT algorithm, digest, size, mtime_ns FROM checksums '
+                                   'WHERE dev = ? AND ino = ?', (dev, ino)).fetchall()
+
+            digests = {}
+            stale = False
+            for algorithm, digest, _size, _mtime_ns in rows:
+                if (_size, _mtime_ns) != (size, mtime_ns):
+                    stale = True
+                    break
+                digests[algorithm] = digest
+
+            if stale:
+                self.db.execute('DELETE FROM checksums WHERE dev = ? AND ino = ?', (dev, ino))
+                self.db.commit()
+                return None
+
+        if not all(a in digests for a in algorithms):
+            return None
+        return dict( (a, digests[a]) for a in algorithms )
+
+    def put(self, st, digests):
+        dev, ino, size, mtime_ns = stat_key(st)
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                [ (dev, ino, size, mtime_ns, a, d) for a, d in digests.iteritems() ])
+            self.db.commit()
+
+cache = None
+if common.checksum_cache:
+    try:
+        cache = ChecksumCache(os.path.expanduser(common.checksum_cache))
+    except (OSError, sqlite3.Error), e:
+        logging.error('Checksum: can not open cache %s: %s', common.checksum_cache, e)
+
+def hash_file(path, algorithms=algorithms, progress=None):
+    """Reads path once feeding every algorithm, returns a dict of
+algorithm -> hex digest. This blocks, run it on the pool.
+
+progress, if given, gets called (from the hashing thread) with the percentage
+done every time it goes up by at least one."""
+    hashes = [ (name, hashlib.new(name)) for name in algorithms ]
+
+    buf = bytearray(_bufsize)
+    view = memoryview(buf)
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        done = 0
+        reported = 0
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            for name, h in hashes:
+                h.update(chunk)
+
+            done += n
+            if progress and size:
+                percent = (100 * done) / size
+                if percent > reported:
+                    reported = percent
+                    progress(float(percent))
+
+    return dict( (name, h.hexdigest()) for name, h in hashes )
+
+def cached_hash_file(path, algorithms=algorithms, progress=None):
+    """Same as hash_file() but answers from the cache when the file has
+not changed since it was last hashed."""
+    if cache is None:
+        return hash_file(path, algorithms, progress)
+
+    st = os.stat(path)
+    digests = cache.get(st, algorithms)
+    if digests is not None:
+        return digests
+
+    digests = hash_file(path, algorithms, progress)
+    # don't remember it if the file was modified while we were reading it.
+    if stat_key(os.stat(path)) == stat_key(st):
+        cache.put(st, digests)
+    return digests
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from pymongo import MongoClient
-import os, shutil
+import os
 
 import config
 
@@ -18,15 +18,102 @@ incoming_dir  = config.get('incoming_dir' , '/media/datos/compartida/patero/inco
 workspace_dir = config.get('workspace_dir', '/media/datos/compartida/patero/workspace')
 output_dir    = config.get('output_dir'   , '/media/datos/compartida/patero/processed')
 
+# how many jobs run at the same time, each one is a full melt/ffmpeg pipeline.
+max_concurrent_jobs = config.get('max_concurrent_jobs', 1)
+# how many independent tasks of a single job can run at the same time.
+per_job_parallelism = config.get('per_job_parallelism', 2)
+# seconds a node can go silent before the jobs it claimed are given to others.
+job_lease_seconds   = config.get('job_lease_seconds', 60)
+# seconds between 'running' heartbeats sent to Caspa.
+status_interval     = config.get('status_interval', 5)
+# progress is written to the database at most once every this many seconds.
+progress_save_interval = config.get('progress_save_interval', 1.0)
+# up to how many sync messages are sent to Redis in one pipeline.
+sync_batch_size     = config.get('sync_batch_size', 100)
+
+# checksums computed for every file besides md5 (which is always there),
+# any name hashlib knows about.
+checksum_algorithms = config.get('checksum_algorithms', [])
+# threads used for hashing files.
+hash_threads        = config.get('hash_threads', 2)
+# sqlite file where checksums are remembered between runs, empty disables it.
+# it is keyed by inode so keep it local to the machine.
+checksum_cache      = config.get('checksum_cache', '~/.cache/patero/checksums.sqlite')
+
+# melt's audio analysis results are kept in workspace_dir/.melt-cache, up to
+# this many bytes (0 disables it) and days.
+melt_cache_max_bytes = config.get('melt_cache_max_bytes', 256 * 1024 * 1024)
+melt_cache_max_age   = config.get('melt_cache_max_age', 30)
+
+# Long videos are split in segments about this long (0 disables it) which
+# are encoded up to segment_parallelism at a time and joined afterwards.
+segment_seconds      = config.get('segment_seconds', 0)
+segment_parallelism  = config.get('segment_parallelism', 2)
+
+# With passthrough on, videos that already match passthrough_format are
+# remuxed instead of transcoded. passthrough_audio_filter (an ffmpeg audio
+# filter like 'loudnorm') re-encodes just the audio through it.
+passthrough              = config.get('passthrough', False)
+passthrough_format       = config.get('passthrough_format', {
+    'video_codec': 'h264',
+    'audio_codec': 'aac',
+    'width': 720,
+    'height': 576,
+    'fps': 25,
+    'aspect': '16:9',
+})
+passthrough_audio_filter = config.get('passthrough_audio_filter', '')
+
+# New files in incoming_dir are picked up once they had no events for this
+# many seconds, monitor_recursive watches its subdirectories too.
+monitor_debounce  = config.get('monitor_debounce', 0.5)
+monitor_recursive = config.get('monitor_recursive', False)
+
+# Jobs done more than this many days ago are moved out of the queue to the
+# transcode_history collection, 0 keeps them in the queue forever.
+history_retention_days = config.get('history_retention_days', 0)
+
+# The queue catches up with changes it missed (like while Redis was away)
+# every resync_interval seconds. Deleted jobs are remembered tombstone_days
+# for that. Every full_resync_interval seconds it reloads every job instead,
+# to see what Caspa changed.
+resync_interval      = config.get('resync_interval', 300)
+full_resync_interval = config.get('full_resync_interval', 3600)
+tombstone_days       = config.get('tombstone_days', 7)
+
+# With write_behind models are saved to mongo from a background thread, with
+# up to write_behind_queue documents waiting and write_behind_batch of them
+# written at once. Saves that must be written wait up to
+# write_behind_flush_timeout seconds for that.
+write_behind       = config.get('write_behind', False)
+write_behind_queue = config.get('write_behind_queue', 1000)
+write_behind_batch = config.get('write_behind_batch', 100)
+write_behind_flush_timeout = config.get('write_behind_flush_timeout', 5)
+
+# Files are moved between directories on this many threads.
+mover_threads = config.get('mover_threads', 2)
+
+# ffprobe runs on up to this many files at a time.
+probe_parallelism = config.get('probe_parallelism', 4)
+
+# Job scheduling, see Patero.score(). schedule_speed is the expected
+# processing seconds per second of video.
+schedule_priority_weight = config.get('schedule_priority_weight', 600)
+schedule_length_weight   = config.get('schedule_length_weight', 1.0)
+schedule_max_penalty     = config.get('schedule_max_penalty', 3600)
+schedule_speed           = config.get('schedule_speed', 1.0)
+
 for folder in [incoming_dir, workspace_dir, output_dir]:
     if not os.path.isdir(folder):
         os.makedirs(folder)
 
-def copy_or_link(source, destination):
-    try:
-        os.link(source, destination)
-    except OSError:
-        shutil.copy2(source, destination)
+def stat_key(s):
+    """Identity of a file from its os.stat(): if any of these change it is
+not the same content anymore."""
+    mtime_ns = getattr(s, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(s.st_mtime * 1e9))
+    return (s.st_dev, s.st_ino, s.st_size, mtime_ns)
 
 def stat_to_dict(s):
     fields = [  'atime', 'blksize', 'blocks', 'ctime',
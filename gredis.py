@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import socket
+import errno
 import uuid
-from multiprocessing import Process, Queue
-from Queue import Empty, Full
+
+import hiredis
+from redis.exceptions import ConnectionError
 
 from gi.repository import GLib, GObject
 
@@ -12,13 +15,16 @@ from gi.repository import GLib, GObject
 class RedisListener(GObject.GObject):
     """
 RedisListener:
-Uses the blocking pubsub.listen() on another process, when a message arrives
-it is sent to the parent and a 'message' signal is emitted.
+Keeps its own pub/sub connection to Redis and watches its socket from the
+GLib main loop. Replies are parsed with hiredis as they arrive, without ever
+blocking, and a 'message' signal is emitted for each published message.
 
 The 'redis' parameter is a connection like the one from  calling redis.Redis()
     """
     __gsignals__ = {
         'message': (GObject.SIGNAL_RUN_FIRST, None, [GObject.TYPE_PYOBJECT]),
+        # messages sent while we were disconnected are lost.
+        'reconnected': (GObject.SIGNAL_RUN_FIRST, None, []),
     }
 
     def __init__(self, redis, client_id=None):
@@ -28,55 +34,124 @@ The 'redis' parameter is a connection like the one from  calling redis.Redis()
         else:
             self.client_id = client_id
 
-        pubsub = redis.pubsub()
-        pubsub.subscribe('__RedisListener_'+unicode(self.client_id))
-
-        self.pubsub = pubsub
-        self.queue = Queue()
-
-        GLib.timeout_add(50, self.check_queue)
-        self.create_worker()
-
-
-    def create_worker(self):
-        kwargs = {
-            'pubsub':    self.pubsub,
-            'queue':     self.queue,
-            'client_id': self.client_id
-        }
-        self.worker = Process(target=self.worker_fn, kwargs=kwargs)
-        self.worker.start()
-
-    def worker_fn(self, pubsub=None, queue=None, client_id=None, *args, **kwargs):
-        """This is executed on *another* process to sidestep blocking reads.
-        As soon as we get something we send it to the other side to be consumed later.
+        self.redis = redis
+        self.connection = None
+        self.reader = None
+        self._watch = None
+        self.channels = set(['__RedisListener_'+unicode(self.client_id)])
+
+        self.connect_pubsub()
+
+    def connect_pubsub(self):
+        """(Re)connects to Redis and subscribes to every known channel."""
+        pool = self.redis.connection_pool
+        connection = pool.connection_class(**pool.connection_kwargs)
+        connection.connect()
+
+        self.connection = connection
+        self.reader = hiredis.Reader()
+        self._watch = GLib.io_add_watch(connection._sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                        GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                        self.on_readable)
+        if self.channels:
+            connection.send_command('SUBSCRIBE', *self.channels)
+
+    def disconnect_pubsub(self):
+        if self._watch is not None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        if self.connection is not None:
+            self.connection.disconnect()
+            self.connection = None
+
+    def reconnect(self):
+        try:
+            self.connect_pubsub()
+        except (ConnectionError, socket.error), e:
+            logging.error('Redis: could not reconnect: %s', e)
+            return True
+
+        logging.info('Redis: reconnected')
+        self.emit('reconnected')
+        return False
+
+    def connection_lost(self):
+        logging.error('Redis: lost pub/sub connection, reconnecting')
+        self._watch = None
+        if self.connection is not None:
+            self.connection.disconnect()
+            self.connection = None
+        GLib.timeout_add_seconds(1, self.reconnect)
+
+    def on_readable(self, source, condition):
+        """This is executed on the main loop when the socket has something
+for us, we only read what is already there.
         """
-        g = pubsub.listen()
+        try:
+            data = self.connection._sock.recv(65536, socket.MSG_DONTWAIT)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = ''
+
+        if not data:
+            self.connection_lost()
+            return False
+
+        self.reader.feed(data)
         while True:
             try:
-                msg = g.next()
-                queue.put(msg)
-            except StopIteration:
-                logging.error('Redis: got StopIteration')
-
-    def check_queue(self):
-        """This is executed on the main process, when something arrives we just
-        emit a signal.
-        """
-        while not self.queue.empty():
-            try:
-                msg = self.queue.get_nowait()
-                if msg['type'] == 'message':
-                    self.emit('message', msg)
-            except Empty:
-                pass
+                reply = self.reader.gets()
+            except hiredis.ProtocolError, e:
+                logging.error('Redis: protocol error: %s', e)
+                self.connection_lost()
+                return False
+
+            if reply is False:
+                break
+            self.on_reply(reply)
+
         return True
 
-    def subscribe(self, channel):
-        self.pubsub.subscribe(channel)
+    def on_reply(self, reply):
+        if not isinstance(reply, list) or not reply:
+            return
+
+        if reply[0] == 'message':
+            msg = {
+                'type':    'message',
+                'pattern': None,
+                'channel': reply[1],
+                'data':    reply[2],
+            }
+            self.emit('message', msg)
 
-    def unsusbcribe(self, channel):
-        self.pubsub.unsubscribe(channel)
+    def subscribe(self, channel):
+        if channel in self.channels:
+            return
+        self.channels.add(channel)
+        if self.connection is None:
+            return
+        try:
+            self.connection.send_command('SUBSCRIBE', channel)
+        except (ConnectionError, socket.error):
+            # taken care of when we reconnect.
+            pass
+
+    def unsubscribe(self, channel):
+        if channel not in self.channels:
+            return
+        self.channels.discard(channel)
+        if self.connection is None:
+            return
+        try:
+            self.connection.send_command('UNSUBSCRIBE', channel)
+        except (ConnectionError, socket.error):
+            # taken care of when we reconnect.
+            pass
+
+    # old misspelled name.
+    unsusbcribe = unsubscribe
 
 
 if __name__ == '__main__':
@@ -3,7 +3,7 @@ from gi.repository import GLib, GObject
 import Process
 
 import tempfile
-import hashlib
+import logging
 import sys
 import os
 import re
@@ -11,7 +11,11 @@ import math
 import fractions
 
 
-from Melt import Transcode as MeltTranscode
+from Melt import Transcode as MeltTranscode, AnalysisCache
+import common
+from threadpool import idle_call
+import checksum
+import probe
 
 _file_types = [
     {
@@ -26,12 +30,184 @@ _file_types = [
     }
 ]
 
-def getFileType(filename):
+# ffprobe format names of still images, besides anything ending in '_pipe'.
+_image_formats = ['image2', 'gif']
+
+def _file_type(name):
     for _type in _file_types:
-        if _type['pattern'].search(filename):
+        if _type['type'] == name:
             return _type
     return None
 
+analysis_cache = None
+if common.melt_cache_max_bytes:
+    analysis_cache = AnalysisCache(os.path.join(common.workspace_dir, '.melt-cache'),
+                                   max_bytes=int(common.melt_cache_max_bytes),
+                                   max_age=float(common.melt_cache_max_age) * 24 * 3600)
+
+def getFileType(filename, info):
+    """Tells what filename is from info, what probe.probe_async() found in
+it. Returns None for files without video or that can't be read. The
+extension is only used if ffprobe is not available."""
+    if not info:
+        if not probe.available:
+            for _type in _file_types:
+                if _type['pattern'].search(filename):
+                    return _type
+        return None
+
+    # cover art in audio files shows up as a video stream.
+    videos = [ s for s in info['streams'] if s.get('codec_type', None) == 'video'
+               and not s.get('disposition', {}).get('attached_pic', 0) ]
+    if not videos:
+        return None
+
+    formats = info['format'].get('format_name', '').split(',')
+    for fmt in formats:
+        if fmt in _image_formats or fmt.endswith('_pipe'):
+            return _file_type('image')
+    return _file_type('video')
+
+def thumbnail_seconds(filename, info):
+    """Where to grab the thumbnail from, never past the middle of the file."""
+    _type = getFileType(filename, info)
+    seconds = 5
+    if _type:
+        seconds = _type['seconds']
+
+    d = probe.duration(info)
+    if d and seconds > d / 2:
+        seconds = d / 2
+    return seconds
+
+def probe_to_metadata(info):
+    """Turns a probe result (see probe.probe_async()) into the metadata dict
+we keep in the job."""
+    # helper functions, the real stuff begins a little below this.
+    def seconds_to_human(secs):
+        msecs, secs= math.modf(secs)
+        secs = int(secs)
+
+        m,s = divmod(secs, 60)
+        h,m = divmod(m, 60)
+
+        # hate hate hate.
+        return ('%.2i:%.2i:%.2i' % (h,m,s)) + ('%.2f'%msecs)[1:]
+
+    def extract_audio_info(stream, fmt):
+        ret = {}
+        if not stream:
+            return ret
+
+        ret['codec'] = stream.get('codec_name', '')
+        ret['sample_rate'] = int( stream.get('sample_rate', 0) )
+        ## XXX: audio bitrate (like 128k mp3) is missing.
+        ##ret['bitrate']
+        ret['channels'] = {'1':'mono', '2':'stereo'}.get(unicode(stream.get('channels', 0)), '')
+        return ret
+
+    def extract_video_info(stream, fmt):
+        ret = {}
+        if not (stream and fmt):
+            return ret
+
+        ret['container'] = fmt.get('format_name', '').split(',')[0]
+        try:
+            ret['bitrate'] = int( fmt.get('bit_rate', 0) )
+        except ValueError:
+            ret['bitrate'] = 0
+        ret['codec'] = stream.get('codec_name', '')
+        num,den = [float(x) for x in stream.get('r_frame_rate', '0.0/1').split('/')]
+        if den:
+            ret['fps'] = num/den
+        else:
+            ret['fps'] = 0.0
+
+        ret['resolution'] = res = {'w': 0, 'h': 0}
+        res['w'] = int( stream.get('width', 0) )
+        res['h'] = int( stream.get('height', 0) )
+
+        # save aspect ratio for auto-padding
+        aspect = stream.get('display_aspect_ratio', '')
+        if aspect and re.match('\d+:\d+', aspect):
+            n,d = [float(x) for x in aspect.split(':')]
+            ret['aspect'] = n / d
+            ret['aspectString'] = aspect
+        else:
+            w,h = res['w'], res['h']
+            if w:
+                ret['aspect'] = float(w) / h
+                f = fractions.Fraction(w,h)
+                ret['aspectString'] = '%i:%i' % (f.numerator, f.denominator)
+            else:
+                ret['aspect'] = 0.0
+                ret['aspectString'] = ''
+
+        # save pixel ratio for output size calculation
+        aspect = stream.get('sample_aspect_ratio', '1:1')
+        if not re.match('\d+:\d+', aspect):
+            aspect = '1:1'
+
+        n,d = [float(x) for x in aspect.split(':')]
+        ret['pixel'] = pixel = n / d
+        ret['pixelString'] = aspect
+
+        # correct video resolution when pixel aspectratio is not 1
+        ret['resolutionSquare'] = res = {'w': 0, 'h': 0}
+        res['w'] = int( stream.get('width', 0) )
+        res['h'] = int( stream.get('height', 0) )
+        if pixel == 1 or pixel == 0:
+            res['w'] = res['w'] * pixel
+
+        #rotate is missing.
+        return ret
+
+    # here.
+    fmt = info['format']
+
+# XXX:  faltan title , que puede estar en stream de video o en format
+# XXX:  date y artist
+    meta = {}
+    meta['synched'] = fmt.get('start_time', None) == '0.000000'
+    meta['durationsec'] = d = float( fmt.get('duration', 0 ))
+    meta['durationraw'] = seconds_to_human(d)
+    meta['audio'] = extract_audio_info(probe.find_stream(info, 'audio'), fmt)
+    meta['video'] = extract_video_info(probe.find_stream(info, 'video'), fmt)
+
+    return meta
+
+def compliance_problems(info, target):
+    """Compares a probe result against target (see passthrough_format in
+common.py) and returns the reasons why it can't be used as it is, an empty
+list means it can be remuxed instead of transcoded."""
+    if not info:
+        return ['unreadable']
+
+    meta = probe_to_metadata(info)
+    video, audio = meta['video'], meta['audio']
+    problems = []
+
+    if video.get('codec', None) != target.get('video_codec', 'h264'):
+        problems.append('video codec %s' % video.get('codec', None))
+    if audio and audio.get('codec', None) != target.get('audio_codec', 'aac'):
+        problems.append('audio codec %s' % audio.get('codec', None))
+
+    res = video.get('resolution', {})
+    if 'width' in target and res.get('w', 0) != target['width']:
+        problems.append('width %s' % res.get('w', 0))
+    if 'height' in target and res.get('h', 0) != target['height']:
+        problems.append('height %s' % res.get('h', 0))
+    if 'fps' in target and abs(video.get('fps', 0) - target['fps']) > 0.01:
+        problems.append('%.3f fps' % video.get('fps', 0))
+    if target.get('aspect', '') and video.get('aspectString', '') != target['aspect']:
+        problems.append('aspect %s' % video.get('aspectString', ''))
+
+    # melt makes it progressive, so must the source be.
+    stream = probe.find_stream(info, 'video') or {}
+    if stream.get('field_order', 'progressive') not in ('progressive', 'unknown'):
+        problems.append('interlaced')
+    return problems
+
 class JobBase(GObject.GObject):
     __gsignals__ = {
         'start': (GObject.SIGNAL_RUN_FIRST, None, (GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT)),
@@ -49,6 +225,8 @@ class JobBase(GObject.GObject):
 
         self.errstr = ''
         self.fail = False
+        self.aborted = False
+        self.processes = []
 
         self.job = job
         self.src = src
@@ -59,10 +237,22 @@ class JobBase(GObject.GObject):
         self.emit ('status', 'Default status message')
         self.alldone()
 
+    def abort (self):
+        """Kills whatever the task is running, it won't touch the job after
+this."""
+        self.aborted = True
+        for p in self.processes:
+            if p.running:
+                try:
+                    p.process.kill()
+                except OSError:
+                    pass
+
     def spawn (self, p):
         p = Process.Handler (p)
         p.connect ('stderr', self.stderr_cb)
         p.connect ('stdout', self.stdout_cb)
+        self.processes.append(p)
         return p
 
     def stderr_cb (self, o, s):
@@ -84,45 +274,39 @@ class JobBase(GObject.GObject):
 
 
 class MD5(JobBase):
+    """Calculates the md5 (and any other configured checksum) of src on the
+hashing threads, the main loop keeps running meanwhile."""
     def __init__(self, job, src=None, dst=None):
         JobBase.__init__(self, job, src, dst)
 
     def start(self):
-        # http://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
         self.emit ('start', self.src, self.dst)
-        md5 = hashlib.md5()
-        try:
-            with open(self.src,'rb') as f:
-                for chunk in iter(lambda: f.read(8192), b''):
-                     md5.update(chunk)
-            self.job['output']['checksum'] = md5.hexdigest()
-            self.emit ('status', 'Calculating checksum')
-            self.emit ('progress', 100.0)
-            self.alldone()
-        except IOError, e:
-            self.emit ('error', unicode(e))
+        self.emit ('status', 'Calculating checksum')
+        checksum.pool.submit(checksum.cached_hash_file, (self.src, checksum.algorithms, self._progress_cb),
+                             self._on_done, self._on_error)
+
+    def _progress_cb(self, progress):
+        # called from the hashing thread.
+        idle_call(self.emit, 'progress', progress)
+
+    def _on_done(self, digests):
+        if self.aborted:
+            return
+        output = self.job['output']
+        output['checksum'] = digests['md5']
+        output.setdefault('checksums', {}).update(digests)
+        self.emit ('progress', 100.0)
+        self.alldone()
+
+    def _on_error(self, e):
+        self.emit ('error', unicode(e))
 
-class Filmstrip(JobBase):
+class FFmpegJob(JobBase):
+    """Base for the tasks that run ffmpeg, turns its stderr into progress."""
     def __init__(self, job, src=None, dst=None):
         JobBase.__init__(self, job, src, dst)
         self.total_time = None
 
-    def start (self):
-
-        if self.dst is None:
-            self.dst = os.path.join( os.path.split(self.src)[0], self.job['output']['checksum']+'.mp4' )
-
-        self.emit ('start', self.src, self.dst)
-        self.emit ('status', 'Making filmstrip video')
-        prog = '-an -r 1 -vf scale=200:ih*200/iw -vcodec libx264'.split()
-        head = ['ffmpeg', '-i', self.src]
-        head.extend(prog)
-        prog = head
-        prog.append('-y')
-        prog.append(self.dst)
-        p = self.spawn(prog)
-        p.connect ('exit', self._on_exit)
-
     def stderr_cb (self, o, s):
         def timetuple_to_seconds(ttuple):
             ttuple = ttuple[:-1]
@@ -144,197 +328,120 @@ class Filmstrip(JobBase):
             self.emit('progress', progress)
 
 
-    def _on_exit(self, process, ret):
-        if ret:
-            self.emit('error', 'FFmpeg error')
-
-        else:
-            self.job['output']['files'].append(self.dst)
-            self.alldone()
-
-
-
 class FFmpegInfo(JobBase):
     def __init__(self, job, src=None, dst=None):
         JobBase.__init__(self, job, src, dst)
-        self.output = []
 
     def start (self):
         self.emit ('start', self.src, self.dst)
         self.emit ('status', 'Extracting metadata')
-        prog = 'ffprobe -show_format -show_streams'.split()
-        prog.append(self.src)
-        p = self.spawn(prog)
-        p.connect ('exit', self._on_exit)
-
-    def stdout_cb (self, o, s):
-        self.output.append(s)
-
-    def _on_exit(self, process, ret):
-    # helper functions, the real stuff begins a little below this.
-        def to_dict(elems):
-            ret = {}
-            for elem in elems:
-                k,v = elem.split('=')
-                ret[k] = v
-            return ret
-
-        def seconds_to_human(secs):
-            msecs, secs= math.modf(secs)
-            secs = int(secs)
-
-            m,s = divmod(secs, 60)
-            h,m = divmod(m, 60)
-
-            # hate hate hate.
-            return ('%.2i:%.2i:%.2i' % (h,m,s)) + ('%.2f'%msecs)[1:]
+        probe.probe_async(self.src, self._on_probe)
 
-        def find_stream_by_codec(streams, codec):
-            for s in streams.values():
-                if codec == s['codec_type']:
-                    return s
-            return None
-
-        def extract_audio_info(stream, fmt):
-            ret = {}
-            if not stream:
-                return ret
-
-            ret['codec'] = stream.get('codec_name', '')
-            ret['sample_rate'] = int( stream.get('sample_rate', 0) )
-            ## XXX: audio bitrate (like 128k mp3) is missing.
-            ##ret['bitrate']
-            ret['channels'] = {'1':'mono', '2':'stereo'}.get(stream.get('channels', 0), '')
-            return ret
-
-        def extract_video_info(stream, fmt):
-            ret = {}
-            if not (stream and fmt):
-                return ret
-
-            ret['container'] = fmt.get('format_name', '').split(',')[0]
-            try:
-                ret['bitrate'] = int( fmt.get('bit_rate', 0) )
-            except ValueError:
-                ret['bitrate'] = 0
-            ret['codec'] = stream.get('codec_name', '')
-            num,den = [float(x) for x in stream.get('r_frame_rate', '0.0/1').split('/')]
-            if den:
-                ret['fps'] = num/den
-            else:
-                ret['fps'] = 0.0
-
-            ret['resolution'] = res = {'w': 0, 'h': 0}
-            res['w'] = int( stream.get('width', 0) )
-            res['h'] = int( stream.get('height', 0) )
-
-            # save aspect ratio for auto-padding
-            aspect = stream.get('display_aspect_ratio', '')
-            if aspect and re.match('\d+:\d+', aspect):
-                n,d = [float(x) for x in aspect.split(':')]
-                ret['aspect'] = n / d
-                ret['aspectString'] = aspect
-            else:
-                w,h = res['w'], res['h']
-                if w:
-                    ret['aspect'] = float(w) / h
-                    f = fractions.Fraction(w,h)
-                    ret['aspectString'] = '%i:%i' % (f.numerator, f.denominator)
-                else:
-                    ret['aspect'] = 0.0
-                    ret['aspectString'] = ''
-
-            # save pixel ratio for output size calculation
-            aspect = stream.get('sample_aspect_ratio', '1:1')
-            if not re.match('\d+:\d+', aspect):
-                aspect = '1:1'
-
-            n,d = [float(x) for x in aspect.split(':')]
-            ret['pixel'] = pixel = n / d
-            ret['pixelString'] = aspect
-
-            # correct video resolution when pixel aspectratio is not 1
-            ret['resolutionSquare'] = res = {'w': 0, 'h': 0}
-            res['w'] = int( stream.get('width', 0) )
-            res['h'] = int( stream.get('height', 0) )
-            if pixel == 1 or pixel == 0:
-                res['w'] = res['w'] * pixel
-
-            #rotate is missing.
-            return ret
-
-        # here.
-        if ret:
+    def _on_probe(self, info):
+        if self.aborted:
+            return
+        if not info:
             self.emit('error', 'ffprobe error')
 
         else:
-            output = ''.join(self.output)
-            streams_raw = re.findall(re.compile('\[STREAM\](.+?)\[/STREAM\]', re.M | re.S), output)
-            fmt_raw = re.findall(re.compile('\[FORMAT\](.+?)\[/FORMAT\]', re.M | re.S), output)
+            self.job['output']['metadata'].update( probe_to_metadata(info) )
+            self.alldone()
 
-            streams_raw = [item.strip().split('\n') for item in streams_raw]
-            fmt_raw = [item.strip().split('\n') for item in fmt_raw]
 
-            streams = {}
-            for idx, s in enumerate(streams_raw):
-                streams[idx] = to_dict(s)
-            fmt = to_dict(fmt_raw[0])
+class Analyze(FFmpegJob):
+    """Makes the filmstrip video and the thumbnail decoding src only once: a
+single ffmpeg splits the decoded video between both outputs. The probe it
+needs for the thumbnail also gives the metadata; with probe=False that is
+left to a FFmpegInfo task."""
+    def __init__(self, job, src=None, dst=None, probe=True):
+        FFmpegJob.__init__(self, job, src, dst)
+        self.probe = probe
+        self.info = None
 
-# XXX:  faltan title , que puede estar en stream de video o en format
-# XXX:  date y artist
-            meta = {}
-            meta['synched'] = fmt.get('start_time', None) == '0.000000'
-            meta['durationsec'] = d = float( fmt.get('duration', 0 ))
-            meta['durationraw'] = seconds_to_human(d)
-            meta['audio'] = extract_audio_info(find_stream_by_codec(streams, 'audio'), fmt)
-            meta['video'] = extract_video_info(find_stream_by_codec(streams, 'video'), fmt)
+    def start (self):
+        base = os.path.join( os.path.split(self.src)[0], self.job['output']['checksum'] )
+        self.filmstrip = base + '.mp4'
+        self.thumbnail = base + '.jpg'
 
-            self.job['output']['metadata'].update(meta)
+        self.emit ('start', self.src, self.dst)
+        if self.probe:
+            self.emit ('status', 'Making filmstrip, thumbnail and metadata')
+        else:
+            self.emit ('status', 'Making filmstrip and thumbnail')
+        probe.probe_async(self.src, self._on_probe)
 
-            self.alldone()
+    def _on_probe(self, info):
+        if self.aborted:
+            return
+        if self.probe and not info:
+            self.emit('error', 'ffprobe error')
+            return
+        self.info = info
+
+        seconds = thumbnail_seconds(self.src, info)
+        graph = ';'.join([
+            '[0:v]split=2[strip][thumb]',
+            '[strip]fps=1,scale=200:ih*200/iw[stripout]',
+            '[thumb]trim=start=%s,setpts=PTS-STARTPTS,scale=150:100[thumbout]' % seconds,
+        ])
+        prog = ['ffmpeg', '-i', self.src, '-filter_complex', graph,
+                '-map', '[stripout]', '-an', '-vcodec', 'libx264', '-y', self.filmstrip,
+                '-map', '[thumbout]', '-an', '-vcodec', 'mjpeg', '-vframes', '1', '-y', self.thumbnail]
+        p = self.spawn(prog)
+        p.connect ('exit', self._on_exit)
 
-class Thumbnail(JobBase):
-    def __init__(self, job, src=None, dst=None):
-        JobBase.__init__(self, job, src, dst)
+    def _on_exit(self, process, ret):
+        if self.aborted:
+            return
+        if ret:
+            self.emit('error', 'FFmpeg error')
+            return
 
-    def start (self):
+        if self.probe:
+            self.job['output']['metadata'].update( probe_to_metadata(self.info) )
+        self.job['output']['files'].append(self.filmstrip)
+        self.job['output']['files'].append(self.thumbnail)
+        self.alldone()
 
-        if self.dst is None:
-            self.dst = os.path.join( os.path.split(self.src)[0], self.job['output']['checksum']+'.jpg' )
 
-        _type = getFileType(self.src)
-        seconds = '5'
-        if _type:
-            seconds = _type['seconds']
-        seconds = unicode(seconds)
+class Remux(FFmpegJob):
+    """Copies the video (and audio, unless audio_filter is given, then only
+that gets encoded) of an already compliant src into dst."""
+    def __init__(self, job, src=None, dst=None, audio_filter=None):
+        FFmpegJob.__init__(self, job, src, dst)
+        self.audio_filter = audio_filter
 
+    def start (self):
         self.emit ('start', self.src, self.dst)
-        self.emit ('status', 'Making thumbnail')
-        prog = '-an -r 1 -vcodec mjpeg -vframes 1 -s 150x100 -ss'.split()
-        head = ['ffmpeg', '-i', self.src]
-        head.extend(prog)
-        prog = head
-        prog.append(seconds)
-        prog.append('-y')
-        prog.append(self.dst)
+        prog = ['ffmpeg', '-i', self.src, '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy']
+        if self.audio_filter:
+            self.emit ('status', 'Remuxing video, fixing audio')
+            prog.extend(['-af', self.audio_filter, '-c:a', 'aac', '-strict', 'experimental', '-b:a', '192k'])
+        else:
+            self.emit ('status', 'Remuxing video')
+            prog.extend(['-c:a', 'copy'])
+        prog.extend(['-movflags', '+faststart', '-y', self.dst])
         p = self.spawn(prog)
         p.connect ('exit', self._on_exit)
 
     def _on_exit(self, process, ret):
         if ret:
             self.emit('error', 'FFmpeg error')
-
         else:
-            self.job['output']['files'].append(self.dst)
             self.alldone()
 
 
 class Transcode(JobBase):
+    """Turns src into something Caspa can play: sources already in the
+passthrough_format are remuxed, everything else goes through melt."""
     def __init__(self, job, src=None, dst=None):
         JobBase.__init__(self, job, src, dst)
 
-        m = self.melt = MeltTranscode(src=src, dst=dst)
+        # only one of them gets made, see start().
+        self.melt = None
+        self.remux = None
 
+    def _connect(self, m):
         m.connect('status', self._emit_msg, 'status')
         m.connect('progress', self._emit_msg, 'progress')
         m.connect('error', self._emit_msg, 'error')
@@ -343,7 +450,39 @@ class Transcode(JobBase):
         m.connect('start', self._start_cb)
 
     def start(self):
-        self.melt.start()
+        if not common.passthrough:
+            self._transcode()
+            return
+        probe.probe_async(self.src, self._on_probe)
+
+    def _transcode(self):
+        # melt gets its temporary files as soon as it is made.
+        m = self.melt = MeltTranscode(src=self.src, dst=self.dst, cache=analysis_cache,
+                                      checksum=self.job['input'].get('checksum', None),
+                                      segment_seconds=float(common.segment_seconds),
+                                      parallelism=int(common.segment_parallelism))
+        self._connect(m)
+        m.start()
+
+    def abort(self):
+        JobBase.abort(self)
+        if self.melt is not None:
+            self.melt.abort()
+        if self.remux is not None:
+            self.remux.abort()
+
+    def _on_probe(self, info):
+        if self.aborted:
+            return
+        problems = compliance_problems(info, common.passthrough_format)
+        if problems:
+            logging.debug('Transcode: %s needs transcoding: %s', self.src, ', '.join(problems))
+            self._transcode()
+            return
+
+        remux = self.remux = Remux(self.job, self.src, self.dst, common.passthrough_audio_filter)
+        self._connect(remux)
+        remux.start()
 
     def _emit_msg(self, melt, payload, msg):
         self.emit(msg, payload)
@@ -352,6 +491,8 @@ class Transcode(JobBase):
         self.emit('start', src, dst)
 
     def _finish_cb(self, melt, src, dst):
+        if self.aborted:
+            return
         self.job['output']['files'].append(dst)
         self.emit('finished', src, dst)
 
@@ -1,7 +1,10 @@
 from common import *
-from backbone import Model, Collection
+import time
+
+from backbone import Model, Collection, db
 
 class Status(Model):
+    __slots__ = ()
     backend = 'transcodestatus'
     defaults= {
         'running': True,
@@ -9,15 +12,18 @@ class Status(Model):
     }
 
 class Job(Model):
+    __slots__ = ()
     backend = 'transcode'
     colname = 'transcode_queue'
     defaults= {
         'input':    {
             'stat': {},
             'path': '',
+            'duration': 0,  # seconds, from probing it when queued.
         },
         'output':    {
             'checksum': '',
+            'checksums': {}, # algorithm: digest, md5 is also in 'checksum'.
             'files': [],
             'metadata': {
                 'type': 'file',
@@ -27,14 +33,61 @@ class Job(Model):
         'stage':    '',
         'progress': '0',
         'tasks':  [], # list of: {name:'', status:'', message:''}
+        'priority': 0,     # higher runs sooner.
+        'deadline': None,  # timestamp it has to be done by, if any.
+        'queued_at': None,
     }
 
 class JobCollection(Collection):
     backend = 'transcode'
     colname = 'transcode_queue'
     model   = Job
+    indexes = ['stage', 'priority', 'deadline']
+    db_indexes = [
+        [('stage', 1)],
+        [('input.path', 1), ('input.stat.mtime', 1)],
+        [('stage', 1), ('finished', 1)],
+    ]
+    # jobs in these stages are not going anywhere.
+    terminal_stages = ['processing-done', 'processing-error']
+    historyname = 'transcode_history'
+
+    def fetch_active(self):
+        """Fetches only the jobs that still have something to do."""
+        return self.fetch({'query': {'stage': {'$nin': self.terminal_stages}}})
+
+    def _on_sync(self, method, model, data):
+        # finished jobs aren't kept, one Caspa queues again comes whole.
+        _id = model.get(self.model.idAttribute, None)
+        if method == 'update' and _id not in self._models and model.get('filename', None) \
+                and model.get('stage', None) not in self.terminal_stages:
+            self.add(model)
+            return
+        Collection._on_sync(self, method, model, data)
+
+    def archive(self, before, batch=500):
+        """Moves the jobs done before the 'before' timestamp to the history
+collection, returns how many were moved. Jobs done before we kept track
+of when are counted as done now."""
+        history = db[self.historyname]
+        self._col.update({'stage': 'processing-done', 'finished': {'$exists': False}},
+                         {'$set': {'finished': time.time()}}, multi=True)
+
+        moved = 0
+        spec = {'stage': 'processing-done', 'finished': {'$lt': before}}
+        while True:
+            docs = list(self._col.find(spec).limit(batch))
+            if not docs:
+                break
+            # a previous run may have died between both steps.
+            for doc in docs:
+                history.save(doc)
+            self._col.remove({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            moved += len(docs)
+        return moved
 
 class Media(Model):
+    __slots__ = ()
     backend = 'media'
     colname = 'medias'
     defaults= {
@@ -1,3 +1,4 @@
+import os
 import pyinotify
 from gi.repository import GLib, GObject
 
@@ -6,51 +7,77 @@ class EventHandler(pyinotify.ProcessEvent, GObject.GObject):
         'new-file': (GObject.SIGNAL_RUN_FIRST, None, [str]),
     }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, recursive=False, *args, **kwargs):
         pyinotify.ProcessEvent.__init__(self, *args, **kwargs)
         GObject.GObject.__init__(self)
+        self.recursive = recursive
 
     def process_default(self, event):
         if event.dir:
+            # a whole directory moved in, none of its files get events.
+            if self.recursive and event.mask & pyinotify.IN_MOVED_TO:
+                for root, dirs, files in os.walk(event.pathname):
+                    for name in files:
+                        self.emit('new-file', os.path.join(root, name))
             return
 
-        self.emit('new-file', event.pathname)
+        # files are only reported once written (or moved in).
+        if event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+            self.emit('new-file', event.pathname)
 
 class Monitor(GObject.GObject):
+    """Emits 'new-file' for every file written or moved into the watched
+paths. Events are read when the inotify fd becomes readable, and 'new-file'
+only fires once a path has been quiet for debounce seconds, so a burst of
+events for the same file ends up as a single emission. With recursive=True
+subdirectories are watched too, including the ones created later."""
     __gsignals__ = {
         'new-file': (GObject.SIGNAL_RUN_FIRST, None, [str]),
     }
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, debounce=0.5, recursive=False):
         GObject.GObject.__init__(self)
 
+        self.debounce = debounce
+        self.recursive = recursive
+        self._pending = {}  # path -> timeout source id
+
         self.wm = pyinotify.WatchManager()
-        self.handler=EventHandler()
+        self.handler=EventHandler(recursive)
 
-        self.handler.connect('new-file', self._emit_new_file)
+        self.handler.connect('new-file', self._new_file_cb)
 
-        self.notifier = pyinotify.Notifier(self.wm, timeout=10, default_proc_fun=self.handler)
+        self.notifier = pyinotify.Notifier(self.wm, default_proc_fun=self.handler)
 
         if path:
             self.add_path(path)
 
-        GLib.idle_add(self._process_events)
+        self._watch = GLib.io_add_watch(self.wm.get_fd(), GLib.PRIORITY_DEFAULT,
+                                        GLib.IO_IN | GLib.IO_PRI, self._process_events)
 
     def add_path(self, path):
-        self.wm.add_watch(path,
-            pyinotify.IN_CLOSE_WRITE |
-            pyinotify.IN_MOVED_TO
-        )
-
-    def _emit_new_file(self, handler, filepath):
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        if self.recursive:
+            # auto_add needs to see directories being created.
+            mask |= pyinotify.IN_CREATE
+        self.wm.add_watch(path, mask, rec=self.recursive, auto_add=self.recursive)
+
+    def _new_file_cb(self, handler, filepath):
+        source = self._pending.pop(filepath, None)
+        if source is not None:
+            GLib.source_remove(source)
+        self._pending[filepath] = GLib.timeout_add(int(self.debounce * 1000),
+                                                   self._emit_new_file, filepath)
+
+    def _emit_new_file(self, filepath):
+        self._pending.pop(filepath, None)
         self.emit('new-file', filepath)
+        return False
 
-    def _process_events(self):
+    def _process_events(self, source, condition):
         notifier = self.notifier
+        notifier.read_events()
         notifier.process_events()
-        while notifier.check_events():
-            notifier.read_events()
-            notifier.process_events()
         return True
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import hashlib
+import fcntl
+import shutil
+import ctypes
+import ctypes.util
+import logging
+import tempfile
+
+from gi.repository import GObject
+
+import common
+import checksum
+from threadpool import ThreadPool, idle_call
+
+pool = ThreadPool(int(common.mover_threads), 'mover')
+
+_chunk = 64 * 1024 * 1024
+
+# from linux/fs.h, clones the blocks of a file on filesystems that can share
+# them (btrfs, xfs).
+_FICLONE = 0x40049409
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+_loff_t = ctypes.c_longlong
+
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(_loff_t),
+                                 ctypes.c_int, ctypes.POINTER(_loff_t),
+                                 ctypes.c_size_t, ctypes.c_uint]
+
+_sendfile = getattr(_libc, 'sendfile64', None) or getattr(_libc, 'sendfile', None)
+if _sendfile is not None:
+    _sendfile.restype = ctypes.c_ssize_t
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_loff_t), ctypes.c_size_t]
+
+# errors that mean 'can't do it this way', not that the copy failed.
+_unsupported = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+def _reflink(fin, fout):
+    try:
+        fcntl.ioctl(fout, _FICLONE, fin)
+    except (IOError, OSError), e:
+        if e.errno in _unsupported:
+            return False
+        raise
+    return True
+
+def _kernel_copy(call, fin, fout, size, progress):
+    """Copies with copy_file_range() or sendfile() in big chunks, returns
+False if the kernel can't do it for these files."""
+    done = 0
+    offset = _loff_t(0)
+    while done < size:
+        if call is _copy_file_range:
+            ret = call(fin, ctypes.byref(offset), fout, None, min(_chunk, size - done), 0)
+        else:
+            ret = call(fout, fin, ctypes.byref(offset), min(_chunk, size - done))
+        if ret < 0:
+            err = ctypes.get_errno()
+            if done == 0 and err in _unsupported:
+                return False
+            raise OSError(err, os.strerror(err))
+        if ret == 0:
+            break
+        done += ret
+        if progress:
+            progress(done)
+    return True
+
+def _plain_copy(fin, fout, progress, hashes=()):
+    done = 0
+    while True:
+        data = os.read(fin, _chunk)
+        if not data:
+            break
+        for h in hashes:
+            h.update(data)
+        view = memoryview(data)
+        while view:
+            written = os.write(fout, view)
+            view = view[written:]
+        done += len(data)
+        if progress:
+            progress(done)
+
+def copy_file(src, dst, progress=None, hashes=None):
+    """Copies src into dst atomically: the data goes to a temporary file next
+to dst that is fsync()ed and renamed over it, so dst is either missing or
+complete. Tries a reflink first, then copy_file_range(), sendfile() and at
+last plain read()/write(). progress(bytes) is called every chunk. Returns
+the method used.
+
+If hashes (hashlib objects) are given the data is fed to them on the way,
+that needs it to go through us so only the plain copy is used."""
+    size = os.path.getsize(src)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(dst) + '.', suffix='.part',
+                               dir=os.path.dirname(dst) or '.')
+    try:
+        fin = os.open(src, os.O_RDONLY)
+        try:
+            if hashes is not None:
+                _plain_copy(fin, fd, progress, hashes)
+                method = 'copy'
+            elif _reflink(fin, fd):
+                method = 'reflink'
+            elif _copy_file_range and _kernel_copy(_copy_file_range, fin, fd, size, progress):
+                method = 'copy_file_range'
+            elif _sendfile and _kernel_copy(_sendfile, fin, fd, size, progress):
+                method = 'sendfile'
+            else:
+                _plain_copy(fin, fd, progress)
+                method = 'copy'
+        finally:
+            os.close(fin)
+
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+    except:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    # make the rename itself durable.
+    dirfd = os.open(os.path.dirname(dst) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+    return method
+
+def move_file(src, dst, progress=None, hashes=None):
+    """Moves src to dst, a rename if both are on the same filesystem and
+copy_file() plus removing src if not. Returns the method used, hashes only
+got the data if it isn't 'rename'."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    method = copy_file(src, dst, progress, hashes)
+    os.unlink(src)
+    return method
+
+class Mover(GObject.GObject):
+    """Moves a list of (src, dst) files on the mover threads, the main loop
+keeps running meanwhile. dst can be a directory. Emits 'progress' with the
+percentage of bytes moved, then 'done' with the list of destination paths
+or 'error' with a message; files already moved when an error happens stay
+where they are.
+
+With checksum=True the md5 of every file ends up in self.checksums (in the
+same order), taken while the file is copied so it isn't read again. Files
+that are only renamed are hashed where they land, once."""
+    __gsignals__ = {
+        'progress': (GObject.SIGNAL_RUN_FIRST, None, (float,)),
+        'done': (GObject.SIGNAL_RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
+        'error': (GObject.SIGNAL_RUN_FIRST, None, (GObject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self, files, checksum=False):
+        GObject.GObject.__init__(self)
+        self.files = list(files)
+        self.checksum = checksum
+        self.checksums = []
+
+    def start(self):
+        pool.submit(self._move, (), self._on_done, self._on_error)
+
+    def _move(self):
+        # runs on a mover thread.
+        sizes = []
+        for src, dst in self.files:
+            try:
+                sizes.append(os.path.getsize(src))
+            except OSError:
+                sizes.append(0)
+        total = float(sum(sizes)) or 1.0
+
+        moved = []
+        base = 0
+        for (src, dst), size in zip(self.files, sizes):
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            progress = lambda done, base=base: idle_call(self.emit, 'progress', 100.0 * (base + done) / total)
+            hashes = None
+            if self.checksum:
+                hashes = [ hashlib.md5() ]
+            method = move_file(src, dst, progress, hashes)
+            if self.checksum and method == 'rename':
+                # nothing went through us, it has to be read.
+                self.checksums.append(checksum.cached_hash_file(dst, ['md5'])['md5'])
+            elif self.checksum:
+                self.checksums.append(hashes[0].hexdigest())
+            logging.debug('Mover: %s -> %s (%s)', src, dst, method)
+            moved.append(dst)
+            base += size
+        return moved
+
+    def _on_done(self, moved):
+        self.emit('progress', 100.0)
+        self.emit('done', moved)
+
+    def _on_error(self, e):
+        self.emit('error', unicode(e))
@@ -4,199 +4,526 @@
 import logging
 import sys, os, shutil
 import uuid
-from collections import deque
+import time
 
 from gi.repository import GLib, GObject
 
 import redis,json
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 from common import *
 import common
-from jobs import getFileType, Transcode, MD5, Filmstrip, FFmpegInfo, Thumbnail
+from jobs import getFileType, Transcode, MD5, FFmpegInfo, Analyze
 from models import Status, Job, JobCollection, Media
 from monitor import Monitor
-
-class Patero(GObject.GObject):
+from workqueue import WorkQueue
+import mover
+from mover import Mover
+import checksum
+import probe
+from backbone import listener
+
+def workspace_name(filepath):
+    """Name filepath gets in the workspace: its path under incoming_dir with
+the directories folded in, so same-named files from different
+subdirectories don't overwrite each other."""
+    rel = os.path.relpath(filepath, common.incoming_dir)
+    if rel.startswith(os.pardir + os.sep):
+        return os.path.basename(filepath)
+    return rel.replace(os.sep, '_')
+
+class Worker(GObject.GObject):
+    """A job slot. Owns the tasks of the job it is running so several of
+them can be busy at the same time.
+
+The tasks of a job form a dependency graph, every task whose dependencies
+are done gets started, up to per_job_parallelism of them at once."""
     __gsignals__ = {
         'finished': (GObject.SIGNAL_RUN_FIRST, None, [GObject.TYPE_PYOBJECT]),
+        'idle': (GObject.SIGNAL_RUN_FIRST, None, []),
     }
-    def __init__(self):
+    def __init__(self, workqueue, parallelism=1):
         GObject.GObject.__init__(self)
 
-        queue = self.queue = JobCollection()
-        queue.fetch()
-
-        self.tasks = deque()
-        self.status = Status()
+        self.workqueue = workqueue
+        self.parallelism = max(1, parallelism)
+        self.job = None
         self.running = False
+        self._lease_timer = None
+        self._reset()
+
+    def _reset(self):
+        self.waiting = []    # list of (task, set of tasks it depends on)
+        self.active = set()
+        self.done = set()
+        self.entries = {}    # task -> index of its entry in job['tasks']
+        self.failed = False
+        self._scheduling = False
+
+    def run(self, job):
+        self.running = True
+        self.job = job
+
+        # keep our claim on the job alive for as long as we work on it.
+        interval = max(1, int(self.workqueue.lease) / 3)
+        self._lease_timer = GLib.timeout_add_seconds(interval, self._renew_lease)
+
+        # the job may be a leftover from a node that died halfway.
+        job['stage'] = 'about-to-process'
+        job['progress'] = 0
+        job['tasks'] = []
+        job['output']['files'] = []
+        job.save()
 
-        GLib.timeout_add(500, self.transcode)
-        GLib.timeout_add(500, self.send_status)
+        filename = job['filename']
+        src = os.path.join(common.workspace_dir, filename)
+        dst = os.path.splitext(filename)[0] + '.m4v'
+        dst = os.path.join(common.workspace_dir, dst)
 
+        probe.probe_async(src, self._probe_cb, job, src, dst)
 
-    def send_status(self, status=None):
-        self.status.save({'_id':1, 'running': True})
-        return True
+    def _probe_cb(self, info, job, src, dst):
+        if job is not self.job:
+            # released while ffprobe was running.
+            return
 
-    def transcode(self):
-        if self.running:
-            return True
+        _type = getFileType(src, info)
+        if _type is None:
+            logging.error('Error: %s is not a media file we know of', src)
+            job['stage'] = 'processing-error'
+            job['tasks'].append({
+                'name': 'Checking file',
+                'status': 'failed',
+                'message': 'Error: unreadable or unsupported file',
+            })
+            job.save(None, {'flush': True})
+            self.release()
+            return
 
-        job = self.queue.findWhere({'stage': 'queued'})
+        if _type['type'] == 'video':
+            transcode = Transcode(job, src, dst)
+            transcode.connect('finished', self.on_transcode_finish)
+            self.add_task(transcode)
 
-        if not job:
-            return True
+            # yeah, looks weird but we want the md5 of the already transcoded file.
+            # (and everything else too)
+            src = dst
+            after = [transcode]
+        else:
+            after = []
 
-        job['stage'] = 'about-to-process'
-        job.save()
+        md5 = self.add_task(MD5(job, src), after)
+        self.add_task(FFmpegInfo(job, src), after)
+        # the filmstrip and thumbnail are named after the checksum.
+        self.add_task(Analyze(job, src, probe=False), [md5])
 
-        def progress_cb(task, progress):
-            job = task.job
-            ##logging.debug('Progress: %s', progress)
-            job['progress'] = progress
-            job.save()
+        self.schedule()
 
+    def _renew_lease(self):
+        if self.job is None:
+            return False
+        if self.workqueue.renew(self.job.id):
+            return True
 
-        def start_cb(task, src, dst):
-            job = task.job
-            logging.debug('Start: %s', src)
-            job['stage'] = 'processing'
+        # the job was given to someone else, whatever we do now would clash.
+        self._lease_timer = None
+        self.drop()
+        return False
+
+    def drop(self):
+        """Stops the tasks of the current job and forgets it without saving
+anything, for when it isn't ours anymore."""
+        job = self.job
+        logging.error('Lost the lease on %s, dropping it', job['filename'])
+        active = self.active
+        self._reset()
+        for task in active:
+            task.abort()
+        job.discard_changes()
+
+        # not ours to release either.
+        self.job = None
+        self.release()
+
+    def release(self):
+        if self._lease_timer is not None:
+            GLib.source_remove(self._lease_timer)
+            self._lease_timer = None
+        if self.job is not None:
+            self.workqueue.release(self.job.id)
+        self._reset()
+        self.job = None
+        self.running = False
+        self.emit('idle')
+
+    def add_task(self, task, after=None):
+        """Adds task to the graph, it will be started once every task in
+'after' succeeded."""
+        self.waiting.append( (task, set(after or [])) )
+        task.connect('progress', self.progress_cb)
+        task.connect('success', self.success_cb)
+        task.connect('status', self.status_cb)
+        task.connect('start', self.start_cb)
+        task.connect('error', self.error_cb)
+        return task
+
+    def schedule(self):
+        # tasks can finish from inside start(), don't recurse on that.
+        if self._scheduling:
+            return
+        self._scheduling = True
+        try:
+            while not self.failed and len(self.active) < self.parallelism:
+                ready = None
+                for node in self.waiting:
+                    if node[1] <= self.done:
+                        ready = node
+                        break
+                if ready is None:
+                    break
+
+                self.waiting.remove(ready)
+                self.active.add(ready[0])
+                ready[0].start()
+        finally:
+            self._scheduling = False
+
+        if self.active or self.job is None:
+            return
+
+        job = self.job
+        if self.failed:
+            self.release()
+        elif not self.waiting:
+            logging.debug('Ok: %s', job['filename'])
+            job['stage'] = 'processing-done'
             job['progress'] = 0
-            job.save()
+            job['finished'] = time.time()
+            job.save(None, {'flush': True})
 
-        def error_cb(task, msg):
-            job = task.job
-            # XXX: get rid of all files here?
-            logging.error('Error: %s', msg)
-            job['stage'] = 'processing-error'
-            if job['tasks']:
-                job['tasks'][-1]['status'] = 'failed'
-                job['tasks'][-1]['message'] = 'Error: ' + msg
-            job.save()
-            self.tasks.clear()
-            self.running = False
+            self.emit('finished', job)
+            self.release()
+        else:
+            # can only happen if the graph has a cycle.
+            self.error_cb(self.waiting[0][0], 'Unsatisfiable task dependencies')
 
-        def status_cb(task, msg):
-            job = task.job
-            logging.debug('Stage: %s', msg)
-            if job['tasks']:
-                job['tasks'][-1]['status'] = 'done'
-            job['tasks'].append({'name':msg, 'status':'processing', 'message':''})
-            job.save()
+    def progress_cb(self, task, progress):
+        if task not in self.active:
+            return
+        job = task.job
+        ##logging.debug('Progress: %s', progress)
+        job['progress'] = progress
+        # stage changes call save() which writes whatever is pending.
+        job.save_later(common.progress_save_interval)
+
+    def start_cb(self, task, src, dst):
+        if task not in self.active:
+            return
+        job = task.job
+        logging.debug('Start: %s', src)
+        job['stage'] = 'processing'
+        job['progress'] = 0
+        job.save()
 
-        def start(*args):
-            self.running = True
-            task = self.tasks.popleft()
-            job = task.job
-            if job['tasks']:
-                job['tasks'][-1]['status'] = 'done'
-            task.start()
+    def _entry(self, task):
+        if task in self.entries:
+            return task.job['tasks'][self.entries[task]]
+        return None
 
-        def success_cb(task, dst):
-            job = task.job
+    def error_cb(self, task, msg):
+        # late errors from a task that already failed, or from the previous
+        # job of this slot, must not touch the current one.
+        if task not in self.active:
+            return
+        self.active.discard(task)
 
-            if job['tasks']:
-                job['tasks'][-1]['status'] = 'done'
-                job.save()
+        logging.error('Error: %s', msg)
+        if not self.failed:
+            job = task.job
+            # XXX: get rid of all files here?
+            job['stage'] = 'processing-error'
+            entry = self._entry(task)
+            if entry is not None:
+                entry['status'] = 'failed'
+                entry['message'] = 'Error: ' + msg
+            job.save(None, {'flush': True})
+
+        # whatever is still running is left to finish, but nothing new starts.
+        self.failed = True
+        self.waiting = []
+        self.schedule()
+
+    def status_cb(self, task, msg):
+        if task not in self.active:
+            return
+        job = task.job
+        logging.debug('Stage: %s', msg)
+        entry = self._entry(task)
+        if entry is not None:
+            entry['status'] = 'done'
+        self.entries[task] = len(job['tasks'])
+        job['tasks'].append({'name':msg, 'status':'processing', 'message':''})
+        job.save()
 
-            if not self.tasks:
-                logging.debug('Ok: %s', dst)
-                job['stage'] = 'processing-done'
-                job['progress'] = 0
-                job.save()
+    def success_cb(self, task, dst):
+        if task not in self.active:
+            return
 
-                self.emit('finished', job)
-                self.running = False
-                return
-            else:
-                start()
+        job = task.job
+        entry = self._entry(task)
+        if entry is not None:
+            entry['status'] = 'done'
+            job.save()
 
-        def add_task(task):
-            self.tasks.append(task)
-            task.connect('progress', progress_cb)
-            task.connect('success', success_cb)
-            task.connect('status', status_cb)
-            task.connect('start', start_cb)
-            task.connect('error', error_cb)
+        self.active.discard(task)
+        self.done.add(task)
+        self.schedule()
 
-        filename = job['filename']
-        src = os.path.join(common.workspace_dir, filename)
-        dst = os.path.splitext(filename)[0] + '.m4v'
-        dst = os.path.join(common.workspace_dir, dst)
+    def on_transcode_finish(self, task, src, dst):
+        if task.aborted:
+            return
+        task.job['output']['transcoded'] = os.path.join(common.output_dir, os.path.basename(dst))
+        task.job['output']['stat'] = {}
+        # XXX: this may end up with a different inode number after moving to processed dir.
+        try:
+            task.job['output']['stat'] = stat_to_dict(os.stat(dst))
+        except OSError:
+            pass
+        task.job.save()
 
-        def on_transcode_finish(task, src, dst):
-            task.job['output']['transcoded'] = os.path.join(common.output_dir, os.path.basename(dst))
-            task.job['output']['stat'] = {}
-            # XXX: this may end up with a different inode number after moving to processed dir.
-            try:
-                task.job['output']['stat'] = stat_to_dict(os.stat(dst))
-            except OSError:
-                pass
-            task.job.save()
 
-        _type = getFileType(src)
-        if _type['type'] == 'video':
-            task = Transcode(job, src, dst)
-            task.connect('finished', on_transcode_finish)
-            add_task(task)
+class Patero(GObject.GObject):
+    __gsignals__ = {
+        'finished': (GObject.SIGNAL_RUN_FIRST, None, [GObject.TYPE_PYOBJECT]),
+    }
+    def __init__(self):
+        GObject.GObject.__init__(self)
 
-            # yeah, looks weird but we want the md5 of the already transcoded file.
-            task = MD5(job, src=dst)
-            add_task(task)
+        queue = self.queue = JobCollection()
+        queue.ensure_indexes()
+        # finished jobs stay in mongo, there's no point in keeping them around.
+        queue.fetch_active()
+        queue.bindRedis()
 
-            # even worse but we want the filmstrip of the already transcoded file.
-            src = dst
-            task = Filmstrip(job, src)
-            add_task(task)
+        self.status = Status()
+        self._probing = set()    # files queue_file() is probing or saving a job for
+
+        lease = max(3, int(common.job_lease_seconds))
+        self.workqueue = WorkQueue(queue._channel + '.queue', lease=lease)
+
+        self.workers = []
+        for i in range(max(1, int(common.max_concurrent_jobs))):
+            worker = Worker(self.workqueue, int(common.per_job_parallelism))
+            worker.connect('finished', self._worker_finished_cb)
+            worker.connect('idle', self._worker_idle_cb)
+            self.workers.append(worker)
+
+        # jobs are dispatched when something happens: a job gets queued
+        # (here or on another node) or a slot frees up.
+        self._dispatch_id = None
+        queue.on('add', self._job_changed_cb)
+        queue.on('change:stage', self._job_changed_cb)
+        queue.on('change:priority', self._job_rescheduled_cb)
+        queue.on('change:deadline', self._job_rescheduled_cb)
+        queue.on('remove', self._job_removed_cb)
+        self.workqueue.watch(self._work_queued_cb)
+
+        GLib.timeout_add_seconds(max(1, int(common.status_interval)), self.send_status)
+        GLib.timeout_add_seconds(lease, self.requeue_expired)
+        GLib.timeout_add_seconds(max(1, int(common.resync_interval)), self.resync)
+        listener.connect('reconnected', lambda listener: self.resync())
+        if int(common.full_resync_interval) > 0:
+            GLib.timeout_add_seconds(int(common.full_resync_interval), self.resync, True)
+        if float(common.history_retention_days) > 0:
+            self.archive()
+            GLib.timeout_add_seconds(3600, self.archive)
+        self.schedule_dispatch()
+
+    @property
+    def running(self):
+        return any(worker.running for worker in self.workers)
 
-            task = FFmpegInfo(job, src)
-            add_task(task)
+    def send_status(self, status=None):
+        self.status.save({'_id':1, 'running': True})
+        # save() skips unchanged models but Caspa wants the heartbeat.
+        self.status.sync('update')
+        return True
 
-            task = Thumbnail(job, src)
-            add_task(task)
+    def _worker_finished_cb(self, worker, job):
+        self.emit('finished', job)
+
+    def _worker_idle_cb(self, worker):
+        self.schedule_dispatch()
+
+    def _work_queued_cb(self, workqueue):
+        self.schedule_dispatch()
+
+    def _job_changed_cb(self, job):
+        stage = job.get('stage', None)
+        if stage == 'queued':
+            # queued by Caspa or another node, enqueue() pushes our own
+            # jobs once they are written.
+            if not job.hasChanged('stage'):
+                self.workqueue.push(job.id, self.score(job))
+            self.schedule_dispatch()
+        elif stage in self.queue.terminal_stages:
+            # whoever still works on it holds its own reference.
+            self.queue.remove(job)
+
+    def _job_removed_cb(self, job):
+        # finished or deleted elsewhere, nobody has to claim it anymore.
+        self.workqueue.discard(job.id)
+
+    def _job_rescheduled_cb(self, job):
+        # priorities can be changed from Caspa while the job waits.
+        if job.get('stage', None) == 'queued':
+            self.workqueue.push(job.id, self.score(job))
+
+    def schedule_dispatch(self):
+        """Runs transcode() on the next main loop iteration, several calls
+before that get merged into one."""
+        if self._dispatch_id is None:
+            self._dispatch_id = GLib.idle_add(self._dispatch)
+
+    def _dispatch(self):
+        self._dispatch_id = None
+        self.transcode()
+        return False
+
+    def resync(self, full=False):
+        changes = self.queue.resync(full=full)
+        if full:
+            logging.debug('Full resync: %d jobs', changes)
+        elif changes:
+            logging.debug('Resync: %d jobs changed', changes)
+        return True
 
-        else:
-            task = MD5(job, src)
-            add_task(task)
+    def archive(self):
+        before = time.time() - float(common.history_retention_days) * 24 * 3600
+        moved = self.queue.archive(before)
+        if moved:
+            logging.info('Moved %d finished jobs to %s', moved, self.queue.historyname)
+        return True
 
-            task = Filmstrip(job, src)
-            add_task(task)
+    def requeue_expired(self):
+        ids = self.workqueue.requeue_expired(self._requeue_score)
+        if ids:
+            self.schedule_dispatch()
+        return True
 
-            task = FFmpegInfo(job, src)
-            add_task(task)
+    def _requeue_score(self, _id):
+        # jobs we don't have aren't fetched just for this, they go back
+        # scored as new.
+        if _id not in self.queue:
+            return None
+        return self.score(self.queue.get(_id))
+
+    def score(self, job):
+        """Where job goes in the shared queue, the lowest score runs first.
+
+It starts at the time the job was queued, so the longer a job waits the
+sooner it runs. Long videos are pushed back by their expected processing
+time (up to schedule_max_penalty seconds, so they don't starve), and every
+point of priority moves a job schedule_priority_weight seconds ahead. A job
+with a deadline runs no later than it needs to start to make it."""
+        queued_at = float(job.get('queued_at', None) or time.time())
+        duration = float(job['input'].get('duration', 0) or 0)
+        expected = duration * float(common.schedule_speed)
+
+        score = queued_at
+        score += min(expected * float(common.schedule_length_weight), float(common.schedule_max_penalty))
+        score -= float(job.get('priority', 0) or 0) * float(common.schedule_priority_weight)
+
+        deadline = job.get('deadline', None)
+        if deadline:
+            score = min(score, float(deadline) - expected)
+        return score
+
+    def enqueue(self, job):
+        """Marks the job as queued and makes it available to every node, the
+stage has to be in the database before another node claims it, so it is
+only pushed once written."""
+        job['stage'] = 'queued'
+        job['queued_at'] = time.time()
+        job.save(None, {'success': lambda: self.workqueue.push(job.id, self.score(job))})
+
+    def get_job(self, _id):
+        """Returns the job with that id, loading it from the database if
+it was queued by another node."""
+        try:
+            return self.queue.get(_id)
+        except KeyError:
+            pass
 
-            task = Thumbnail(job, src)
-            add_task(task)
+        job = Job({'_id': _id})
+        job.fetch()
+        if not job['filename']:
+            return None
 
+        self.queue.add(job)
+        return job
 
-        start()
+    def transcode(self):
+        for worker in self.workers:
+            if worker.running:
+                continue
+
+            _id = self.workqueue.claim()
+            if _id is None:
+                break
+
+            job = self.get_job(_id)
+            if job is None:
+                logging.warning('Claimed job %s does not exist, dropping it', _id)
+                self.workqueue.release(_id)
+                continue
+
+            worker.run(job)
+
+    def queue_file(self, filepath, do_copy=True, stat=None, checked=False):
+        """Creates a job for filepath and queues it, once ffprobe (which
+runs without blocking) says it is something we can handle. stat can be
+passed if already known, and checked=True skips looking for a job for the
+same file."""
+        if stat is None:
+            try:
+                stat = stat_to_dict(os.stat(filepath))
+            except OSError:
+                return
 
-        return True
+        # not reimplementing as mongo is quite good at this.
+        if not checked and self.queue._col.find({ 'input.path': filepath, 'input.stat.mtime': stat['mtime']}).count():
+            return
 
-    def queue_file(self, filepath, do_copy=True):
-        try:
-            stat = stat_to_dict(os.stat(filepath))
-        except OSError:
+        # a file reported again before its job is written is queued only once.
+        if filepath in self._probing:
             return
+        self._probing.add(filepath)
+        probe.probe_async(filepath, self._queue_probed_cb, filepath, stat, do_copy)
 
-        filename = os.path.basename(filepath)
-        _type = getFileType(filepath)
+    def _queue_probed_cb(self, info, filepath, stat, do_copy):
+        filename = workspace_name(filepath)
+        _type = getFileType(filepath, info)
 
         if not _type:
+            self._probing.discard(filepath)
             logging.debug('File not recognized: %s', filepath)
             return
 
-        # not reimplementing as mongo is quite good at this.
-        if self.queue._col.find({ 'input.stat.mtime': stat['mtime'], 'path': filepath}).count():
-            return
-
         job = Job( {
             'input':    {
                 'stat': stat,
                 'path': filepath,
+                # used for scheduling.
+                'duration': probe.duration(info),
             },
             'output':    {
                 'checksum': '',
+                'checksums': {},
                 'files': [],
                 'metadata': {
                     'type': _type['type'],
@@ -208,50 +535,106 @@ class Patero(GObject.GObject):
             'tasks':  [], # list of: {name:'', status:'', message:''}
         })
 
-        job.save()
+        # once written the job is what tells the file is taken care of.
+        job.save(None, {'success': lambda: self._queue_saved_cb(job, filepath, do_copy)})
 
-        if do_copy:
-            try:
-                copy_or_link(filepath, os.path.join(common.workspace_dir, filename))
-                job['stage'] = 'queued'
-                os.unlink(filepath)
-            except:
-                e = sys.exc_info()[1]
-                job['stage'] = 'processing-error'
-                job['tasks'].append({
-                    'name': 'Moving files',
-                    'status': 'failed',
-                    'message': 'Error: ' + unicode(e),
-                })
-            finally:
-                job.save()
-        else:
-            job['stage'] = 'queued'
-            job.save()
+    def _queue_saved_cb(self, job, filepath, do_copy):
+        self._probing.discard(filepath)
+        self.ingest(job, do_copy)
 
+    def ingest(self, job, do_copy=True):
+        """Moves the input of a just created job to the workspace (off the
+main loop), takes its md5 on the way and queues it. As the job is saved
+first, one left with an empty stage had its ingest interrupted and can be
+given here again."""
         self.queue.add(job)
+        if not do_copy:
+            mover.pool.submit(checksum.cached_hash_file, (job['input']['path'], ['md5']),
+                              lambda digests: self._ingested_cb(job, digests['md5']),
+                              lambda e: self._ingested_cb(job, None))
+            return
+
+        dst = os.path.join(common.workspace_dir, job['filename'])
+        m = Mover([ (job['input']['path'], dst) ], checksum=True)
+        m.connect('progress', self._ingest_progress_cb, job)
+        m.connect('done', lambda m, files: self._ingested_cb(job, m.checksums[0]))
+        m.connect('error', self._ingest_error_cb, job)
+        m.start()
+
+    def _ingested_cb(self, job, md5):
+        # the audio analysis cache goes by it, so the input isn't read again
+        # for every transcode.
+        if md5:
+            job['input']['checksum'] = md5
+        self.enqueue(job)
+
+    def _ingest_progress_cb(self, mover, progress, job):
+        job['progress'] = progress
+        job.save_later(common.progress_save_interval)
+
+    def _ingest_error_cb(self, mover, msg, job):
+        logging.error('Error moving %s: %s', job['input']['path'], msg)
+        job['stage'] = 'processing-error'
+        job['tasks'].append({
+            'name': 'Moving files',
+            'status': 'failed',
+            'message': 'Error: ' + msg,
+        })
+        job.save(None, {'flush': True})
+
+    def scan_incoming(self, directory, batch=1000):
+        """Queues every file waiting in directory, looking for the ones that
+already have a job with a few $in queries instead of one per file."""
+        candidates = {}
+        for entry in scandir(directory):
+            try:
+                if not entry.is_file():
+                    continue
+                candidates[entry.path] = stat_to_dict(entry.stat())
+            except OSError:
+                continue
+
+        known = {}
+        paths = candidates.keys()
+        for i in range(0, len(paths), batch):
+            spec = {'input.path': {'$in': paths[i:i+batch]}}
+            for doc in self.queue._col.find(spec, {'input.path': 1, 'input.stat.mtime': 1, 'stage': 1}):
+                key = (doc['input']['path'], doc['input'].get('stat', {}).get('mtime', None))
+                known[key] = doc
+
+        for path in sorted(candidates):
+            stat = candidates[path]
+            doc = known.get( (path, stat['mtime']), None )
+            if doc is None:
+                self.queue_file(path, stat=stat, checked=True)
+            elif not doc.get('stage', ''):
+                logging.info('Resuming ingest of %s', path)
+                job = self.get_job(doc['_id'])
+                if job is not None:
+                    self.ingest(job)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
     p = Patero()
-    m = Monitor(common.incoming_dir)
+    m = Monitor(common.incoming_dir, debounce=float(common.monitor_debounce),
+                recursive=bool(common.monitor_recursive))
 
     queue = p.queue
-    queue.fetch()
 
     def new_file_cb(monitor, filepath):
         p.queue_file(filepath.decode('utf-8'))
     m.connect('new-file', new_file_cb)
 
     def job_finished_cb(patero, job):
-        tmp = []
-        for filename in job['output']['files']:
-            copy_or_link(filename, common.output_dir)
-            os.unlink(filename)
-            tmp.append(os.path.join(common.output_dir, os.path.basename(filename)))
-        job['output']['files'] = tmp
+        mover = Mover([ (filename, common.output_dir) for filename in job['output']['files'] ])
+        mover.connect('done', publish_cb, job)
+        mover.connect('error', lambda mover, msg: logging.error('Error publishing %s: %s', job['filename'], msg))
+        mover.start()
+
+    def publish_cb(mover, files, job):
+        job['output']['files'] = files
         job.save()
 
         # here tell Caspa the file is ready
@@ -269,20 +652,23 @@ if __name__ == '__main__':
     p.connect('finished', job_finished_cb)
 
 
-    for fn in os.listdir(common.incoming_dir):
-        afn = os.path.join(common.incoming_dir, fn)
-        if not os.path.isfile(afn):
-            continue
-        p.queue_file(afn)
+    p.scan_incoming(common.incoming_dir)
 
-    for job in queue.where({'stage': 'processing'}):
-        job.update({
-            'stage': 'queued',
-            'tasks': [],
-            'progress': 0,
-        })
-        job['output']['files'] = []
-        job.save()
+    # jobs other nodes are working on are left alone, their leases take
+    # care of them if the node died.
+    for stage in ['processing', 'about-to-process']:
+        for job in queue.where({'stage': stage}):
+            if p.workqueue.is_leased(job.id):
+                continue
+            job.update({
+                'tasks': [],
+                'progress': 0,
+            })
+            job['output']['files'] = []
+            p.enqueue(job)
+
+    for job in queue.where({'stage': 'queued'}):
+        p.workqueue.push(job.id, p.score(job))
 
     for job in queue.where({'stage': 'moving'}):
         job.destroy()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+from collections import OrderedDict, deque
+
+import Process
+from common import stat_key, probe_parallelism
+
+_command = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams']
+
+# stat_key(file) -> parsed ffprobe output, or None if ffprobe could not read it.
+_cache = OrderedDict()
+_cache_size = 4096
+
+# probes in flight or waiting for a free slot: stat_key -> [(callback, args)],
+# a file asked for again before it is done doesn't get probed twice.
+_waiting = {}
+_pending = deque()   # (path, key) waiting for one of the probe_parallelism slots
+_running = 0
+
+# False once ffprobe could not be run at all (not installed, ...).
+available = True
+
+def _key(path):
+    try:
+        return stat_key(os.stat(path))
+    except OSError:
+        return None
+
+def _remember(key, info):
+    if key is None:
+        return
+    _cache.pop(key, None)
+    _cache[key] = info
+    while len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+
+def _parse(output):
+    try:
+        info = json.loads(output)
+    except ValueError:
+        return None
+    if not info.get('format', None):
+        return None
+    info.setdefault('streams', [])
+    return info
+
+def cached(path):
+    """Returns (info, found) for path without probing it. As the cache is
+keyed by file identity it is still valid after the file is moved or linked."""
+    key = _key(path)
+    if key in _cache:
+        info = _cache.pop(key)
+        _cache[key] = info
+        return (info, True)
+    return (None, False)
+
+def probe_async(path, callback, *args):
+    """Runs ffprobe on path (once per file identity, up to probe_parallelism
+at a time) without blocking the main loop. callback(info, *args) gets its
+parsed JSON output: {'format': {...}, 'streams': [{...}, ...]}, or None if
+the file can't be read. It is called right away if path was probed before."""
+    info, found = cached(path)
+    if found:
+        callback(info, *args)
+        return
+
+    key = _key(path)
+    if key is None:
+        # gone before we got to it.
+        callback(None, *args)
+        return
+
+    if key in _waiting:
+        _waiting[key].append( (callback, args) )
+        return
+    _waiting[key] = [ (callback, args) ]
+    _pending.append( (path, key) )
+    _next()
+
+def _next():
+    global _running, available
+    while _pending and _running < max(1, int(probe_parallelism)):
+        path, key = _pending.popleft()
+        try:
+            p = Process.Handler(_command + [path])
+        except OSError, e:
+            logging.error('Probe: can not run ffprobe: %s', e)
+            available = False
+            _finish(key, None)
+            continue
+
+        _running += 1
+        output = []
+        p.connect('stdout', lambda process, s, output=output: output.append(s))
+        p.connect('exit', _on_exit, key, output)
+
+def _on_exit(process, ret, key, output):
+    global _running
+    _running -= 1
+    info = None
+    if ret == 0:
+        info = _parse(''.join(output))
+    _remember(key, info)
+    _finish(key, info)
+    _next()
+
+def _finish(key, info):
+    for callback, args in _waiting.pop(key, []):
+        callback(info, *args)
+
+def duration(info):
+    """Duration in seconds from a probe result, 0 if unknown."""
+    if not info:
+        return 0.0
+    try:
+        return float(info['format'].get('duration', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def find_stream(info, codec_type):
+    if not info:
+        return None
+    for stream in info['streams']:
+        if stream.get('codec_type', None) == codec_type:
+            return stream
+    return None
+
+_keyframes_command = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+                      '-show_entries', 'frame=pkt_pts_time,pts_time', '-of', 'csv=p=0']
+
+def keyframes_async(path, callback, *args):
+    """Lists the timestamps of the keyframes of the first video stream of
+path, callback(times, *args) gets a sorted list of seconds (empty if
+ffprobe failed). Only keyframes are decoded, but it still reads the whole
+file."""
+    output = []
+
+    def on_exit(process, ret):
+        times = []
+        if ret == 0:
+            for line in ''.join(output).splitlines():
+                for field in line.split(','):
+                    try:
+                        times.append(float(field))
+                        break
+                    except ValueError:
+                        continue
+        callback(sorted(times), *args)
+
+    try:
+        p = Process.Handler(_keyframes_command + [path])
+    except OSError, e:
+        logging.error('Probe: can not run ffprobe: %s', e)
+        callback([], *args)
+        return
+    p.connect('stdout', lambda process, s: output.append(s))
+    p.connect('exit', on_exit)
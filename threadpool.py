@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from Queue import Queue
+
+from gi.repository import GLib, GObject
+
+# older pygobject versions don't let python threads run while the main loop
+# is sleeping unless we ask for it.
+GObject.threads_init()
+
+def idle_call(fn, *args):
+    """Runs fn(*args) once on the main loop, safe to call from any thread."""
+    def _cb():
+        fn(*args)
+        return False
+    GLib.idle_add(_cb)
+
+class ThreadPool(object):
+    """A fixed set of daemon threads to run blocking stuff off the main loop.
+
+submit() queues fn(*args) and, once it is done, callback(result) or
+errback(exception) are called back on the main loop.
+"""
+    def __init__(self, size=2, name='pool'):
+        self.name = name
+        self.queue = Queue()
+        self.threads = []
+
+        for i in range(max(1, size)):
+            thread = threading.Thread(target=self._worker, name='%s-%i' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn, args=(), callback=None, errback=None):
+        self.queue.put( (fn, args, callback, errback) )
+
+    def _worker(self):
+        while True:
+            fn, args, callback, errback = self.queue.get()
+            try:
+                ret = fn(*args)
+            except Exception, e:
+                logging.exception('%s: error running %s', self.name, fn)
+                if errback is not None:
+                    idle_call(errback, e)
+                continue
+
+            if callback is not None:
+                idle_call(callback, ret)
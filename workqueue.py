@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import time
+import json
+import logging
+
+from backbone import redis, listener, publisher, _client_id
+
+# All the state lives in three keys so any number of nodes can share it:
+#   <prefix>.pending  sorted set of job ids waiting to be processed.
+#   <prefix>.leases   sorted set of claimed job ids, scored by lease expiry.
+#   <prefix>.owners   hash of claimed job id -> node that holds the lease.
+# Every state change is done by a Lua script so claiming is atomic.
+
+_PUSH = """
+if redis.call('zscore', KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+_CLAIM = """
+local ids = redis.call('zrange', KEYS[1], 0, 0)
+if #ids == 0 then
+    return false
+end
+local id = ids[1]
+redis.call('zrem', KEYS[1], id)
+redis.call('zadd', KEYS[2], ARGV[1], id)
+redis.call('hset', KEYS[3], id, ARGV[2])
+return id
+"""
+
+_RENEW = """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[3] then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+_RELEASE = """
+if redis.call('hget', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[2], ARGV[1])
+return 1
+"""
+
+# ARGV: now, then pairs of id, score. Leases renewed meanwhile are kept.
+_REQUEUE_EXPIRED = """
+local ids = {}
+for i = 2, #ARGV, 2 do
+    local expiry = redis.call('zscore', KEYS[2], ARGV[i])
+    if expiry and tonumber(expiry) <= tonumber(ARGV[1]) then
+        redis.call('zrem', KEYS[2], ARGV[i])
+        redis.call('hdel', KEYS[3], ARGV[i])
+        redis.call('zadd', KEYS[1], ARGV[i + 1], ARGV[i])
+        table.insert(ids, ARGV[i])
+    end
+end
+return ids
+"""
+
+class WorkQueue(object):
+    """A job queue shared by all the Patero nodes through Redis.
+
+Jobs are pushed by id and claimed by exactly one node, which gets a lease
+it has to keep renewing while working on it. If a node dies its leases
+expire and requeue_expired() puts the jobs back on the pending set.
+"""
+    def __init__(self, name, lease=60, node_id=None):
+        self.name    = name
+        self.lease   = lease
+        self.node_id = node_id or _client_id
+
+        self._pending = name + '.pending'
+        self._leases  = name + '.leases'
+        self._owners  = name + '.owners'
+
+        self._push    = redis.register_script(_PUSH)
+        self._claim   = redis.register_script(_CLAIM)
+        self._renew   = redis.register_script(_RENEW)
+        self._release = redis.register_script(_RELEASE)
+        self._requeue = redis.register_script(_REQUEUE_EXPIRED)
+
+    def push(self, _id, score=None):
+        """Adds a job to the pending set, does nothing if some node holds
+a lease on it. Returns True if it was added or its score updated."""
+        if score is None:
+            score = time.time()
+        ret = bool( self._push(keys=[self._pending, self._leases], args=[_id, score]) )
+        if ret:
+            self.notify()
+        return ret
+
+    def notify(self):
+        """Tells every node watching the queue that there is work to claim."""
+        publisher.publish(self.name, json.dumps({'node': self.node_id}))
+
+    def watch(self, callback, *args):
+        """Calls callback(workqueue, *args) every time work is pushed by
+some node."""
+        def on_message(listener, message):
+            if message.get('channel', None) != self.name:
+                return
+            callback(self, *args)
+
+        listener.subscribe(self.name)
+        return listener.connect('message', on_message)
+
+    def claim(self):
+        """Atomically takes the next pending job and returns its id, or
+None if there is nothing to do."""
+        _id = self._claim(keys=[self._pending, self._leases, self._owners],
+                          args=[time.time() + self.lease, self.node_id])
+        return _id
+
+    def renew(self, _id):
+        """Extends our lease on _id, returns False if we lost it."""
+        ret = self._renew(keys=[self._leases, self._owners],
+                          args=[_id, time.time() + self.lease, self.node_id])
+        if not ret:
+            logging.warning('WorkQueue: lost lease on %s', _id)
+        return bool(ret)
+
+    def release(self, _id):
+        """Drops our lease once the job has been processed (or failed)."""
+        return bool( self._release(keys=[self._leases, self._owners], args=[_id, self.node_id]) )
+
+    def discard(self, _id):
+        """Removes _id from the pending set, if it is there."""
+        redis.zrem(self._pending, _id)
+
+    def is_leased(self, _id):
+        return redis.zscore(self._leases, _id) is not None
+
+    def requeue_expired(self, score=None):
+        """Moves every job whose lease has expired back to the pending set,
+scored by score(_id) when that gives one and by the time now otherwise.
+Returns the list of requeued ids."""
+        now = time.time()
+        expired = redis.zrangebyscore(self._leases, '-inf', now)
+        if not expired:
+            return []
+
+        args = [now]
+        for _id in expired:
+            value = None
+            if score is not None:
+                value = score(_id)
+            args.extend([_id, now if value is None else value])
+        ids = self._requeue(keys=[self._pending, self._leases, self._owners], args=args)
+        for _id in ids:
+            logging.warning('WorkQueue: lease on %s expired, requeued', _id)
+        if ids:
+            self.notify()
+        return ids